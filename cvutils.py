@@ -1,17 +1,192 @@
+import collections
 import cv2
 import numpy as np
+import os
+import queue
+import subprocess
 import time
 
-from threading import Thread
-# Sync using Condition causes critical performance down
-# from threading import Condition
+from threading import Condition, Event, Thread
+from tracing import span
 
 
-class Webcam:
+class Frame:
 
-    def __init__(self):
-        self._cap = cv2.VideoCapture(0)
-        __, self._frame = self._cap.read()
+    # image: numpy array owned by the ring slot
+    # seq: monotonic sequence number, timestamp: perf_counter() at capture
+    # variants: images derived by the source's steps, keyed by step name
+    def __init__(self, image=None, seq=-1, timestamp=0.0):
+        self.image = image
+        self.seq = seq
+        self.timestamp = timestamp
+        self.variants = {}
+
+    # Derived image, or the captured one when the step is not configured
+    def variant(self, name):
+        return self.variants.get(name, self.image)
+
+    # Detached copy for work that outlives the ring slot
+    # variants: names to copy, None copies all of them
+    # image: False leaves the captured image out (image is None)
+    def copy(self, variants=None, image=True):
+        frame = Frame(
+            np.copy(self.image) if image else None,
+            self.seq,
+            self.timestamp
+        )
+        names = self.variants.keys() if variants is None else variants
+        for name in names:
+            value = self.variants.get(name)
+            if isinstance(value, np.ndarray):
+                value = np.copy(value)
+            frame.variants[name] = value
+        return frame
+
+
+class Resize:
+
+    # width, height: target size, height None keeps the aspect ratio
+    # source: variant to read, None for the captured image
+    def __init__(self, width, height=None, source=None, name='resized',
+                 interpolation=cv2.INTER_AREA):
+        self.width = int(width)
+        self.height = height
+        self.source = source
+        self.name = name
+        self.interpolation = interpolation
+
+    def __call__(self, frame):
+        image = frame.variant(self.source)
+        height = self.height or \
+            int(round(image.shape[0] * self.width / image.shape[1]))
+        frame.variants[self.name] = cv2.resize(
+            image,
+            (self.width, int(height)),
+            dst=frame.variants.get(self.name),
+            interpolation=self.interpolation
+        )
+
+
+class DetectionGray:
+
+    # Downscaled grayscale copy for FaceDetector.detect
+    # width: detection width, never larger than the image
+    def __init__(self, width=512, source=None, name='gray'):
+        self.width = int(width)
+        self.source = source
+        self.name = name
+
+    def __call__(self, frame):
+        image = frame.variant(self.source)
+        width = min(self.width, image.shape[1])
+        dsize = (width, int(image.shape[0] * width / image.shape[1]))
+
+        # Shrink first, the color conversion then runs on fewer pixels
+        small = image
+        if dsize[0] != image.shape[1]:
+            small = cv2.resize(image, dsize, interpolation=cv2.INTER_AREA)
+        if small.ndim > 2:
+            small = cv2.cvtColor(
+                small,
+                cv2.COLOR_BGR2GRAY,
+                dst=frame.variants.get(self.name)
+            )
+        frame.variants[self.name] = small
+        # Detections are mapped back with this, without the full image
+        frame.variants[self.name + '_scale'] = width / image.shape[1]
+
+
+class UploadConvert:
+
+    # Texture-ready copy for renderers that cannot swizzle or flip on the
+    # GPU. The video renderers do both in the shader, so this is only
+    # needed for other consumers of the frames.
+    # rgb: convert BGR to RGB, flip: make the image bottom-up
+    def __init__(self, rgb=True, flip=True, source=None, name='upload'):
+        self.rgb = rgb
+        self.flip = flip
+        self.source = source
+        self.name = name
+
+    def __call__(self, frame):
+        image = frame.variant(self.source)
+        # The slot's previous buffer is reused when the size still fits
+        dst = frame.variants.get(self.name)
+        if self.rgb and self.flip:
+            # cvtColor into the slot's buffer, then flip it in place
+            dst = cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=dst)
+            dst = cv2.flip(dst, 0, dst=dst)
+        elif self.rgb:
+            dst = cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=dst)
+        elif self.flip:
+            dst = cv2.flip(image, 0, dst=dst)
+        else:
+            dst = image
+        frame.variants[self.name] = dst
+
+
+class VideoSource:
+
+    # slots: frame buffers in the ring, at least 2 more than the consumers
+    # fps: pacing rate, None lets the device pace itself
+    # realtime: False hands every frame to the consumer before reading the
+    #   next one, so runs are deterministic and as fast as the pipeline
+    # steps: callables run on every Frame on the capture thread before it
+    #   is published, see Resize, DetectionGray and UploadConvert
+    def __init__(self, slots=3, fps=None, realtime=True, steps=()):
+        self.fps = fps
+        self.realtime = realtime
+        self.steps = list(steps)
+
+        # Slots are filled in place by _read_frame; the newest one and the
+        # ones held by consumers are never written to
+        self._slots = [Frame() for _ in range(max(slots, 2))]
+        self._latest = None
+        self._writing = None
+        self._reading = {}
+
+        # Sequence of the newest frame; listeners are called from the
+        # capture thread right after it is bumped
+        self.sequence = 0
+        self.frame_listeners = []
+
+        # A Condition on every frame costs too much, so the capture thread
+        # only notifies while somebody is blocked in wait_for_frame
+        self._cond = Condition()
+        self._waiters = 0
+        self._taken = Event()
+        self._run = False
+        self._thread = None
+
+    # Fill image in place when possible, returns (succeed, image)
+    def _read_frame(self, image):
+        raise NotImplementedError
+
+    def _close(self):
+        pass
+
+    # Publish the first frame so width/height and frame work before start()
+    def _prime(self):
+        slot = self._slots[0]
+        succeed, image = self._read_frame(None)
+        if not succeed:
+            self._taken.set()
+            return
+        slot.image = image
+        slot.seq = 0
+        slot.timestamp = time.perf_counter()
+        self._preprocess(slot)
+        self._latest = 0
+        for other in self._slots[1:]:
+            other.image = np.empty_like(image)
+
+    # OpenCV drops the GIL inside its calls, so this overlaps with the
+    # render thread
+    def _preprocess(self, frame):
+        if self.steps:
+            with span('capture.preprocess'):
+                for step in self.steps:
+                    step(frame)
 
     # Create thread for capturing image
     def start(self):
@@ -24,32 +199,174 @@ class Webcam:
 
     def stop(self):
         self._run = False
-        self._thread.join()
+        self._taken.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self._notify()
+
+    def _free_slot(self):
+        busy = list(self._reading.values())
+        for i in range(1, len(self._slots) + 1):
+            index = ((self._latest or 0) + i) % len(self._slots)
+            if index != self._latest and index not in busy:
+                return index
+        return None
 
     def _update_frame(self):
+        started = time.perf_counter()
+        first = self.sequence
         while self._run:
-            succeed, temp_frame = self._cap.read()
+            # Lockstep: the consumer has to take every frame
+            if not self.realtime and not self._taken.wait(0.1):
+                continue
+
+            index = self._free_slot()
+            if index is not None:
+                # Claim the slot first, then make sure no consumer took
+                # it in the meantime (see _hold)
+                self._writing = index
+                if index in list(self._reading.values()):
+                    self._writing = index = None
+            if index is None:
+                # Every slot is held; the consumers are too slow
+                time.sleep(0.001)
+                continue
+
+            slot = self._slots[index]
+            with span('capture.read'):
+                succeed, image = self._read_frame(slot.image)
+            if succeed:
+                slot.image = image
+                slot.seq = self.sequence + 1
+                slot.timestamp = time.perf_counter()
+                self._preprocess(slot)
+
+                if self.realtime and self.fps:
+                    due = started + (self.sequence + 1 - first) / self.fps
+                    delay = due - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+
+            # The slot is complete, consumers may hold it from here on
+            self._writing = None
             if succeed:
-                self._frame = temp_frame
+                # Under the lock _hold marks frames taken with, so a late
+                # hold of the previous frame cannot mark this one
+                with self._cond:
+                    self._taken.clear()
+                    self._latest = index
+                    self.sequence = slot.seq
+                self._notify()
+                for listener in self.frame_listeners:
+                    listener()
             self._run = self._run and succeed
+        self._notify()
+
+    def _notify(self):
+        if self._waiters:
+            with self._cond:
+                self._cond.notify_all()
+
+    # Hold a slot for consumer. The capture thread claims a slot before
+    # checking the holds, so either it sees this hold or we see its claim.
+    def _hold(self, consumer, index, seq):
+        self._reading[consumer] = index
+        frame = self._slots[index]
+        if self._writing == index or frame.seq != seq:
+            return None
+        if not self.realtime:
+            with self._cond:
+                if frame.seq == self.sequence:
+                    self._taken.set()
+        return frame
+
+    # Newest Frame without copying. The slot stays valid until the same
+    # consumer calls read() again or release().
+    def read(self, consumer=None):
+        while True:
+            index = self._latest
+            if index is None:
+                return None
+            frame = self._hold(consumer, index, self._slots[index].seq)
+            if frame is not None:
+                return frame
+
+    # Frame captured closest to timestamp among those still in the ring,
+    # held like read()
+    def nearest(self, timestamp, consumer=None):
+        while True:
+            candidates = [
+                (abs(f.timestamp - timestamp), i, f.seq)
+                for i, f in enumerate(self._slots)
+                if f.seq >= 0 and i != self._writing
+            ]
+            if not candidates:
+                return None
+            __, index, seq = min(candidates)
+            frame = self._hold(consumer, index, seq)
+            if frame is not None:
+                return frame
+
+    def release(self, consumer=None):
+        self._reading.pop(consumer, None)
 
+    # Block until a frame newer than after_seq arrives; None on timeout
+    # or when the source has ended
+    def wait_for_frame(self, after_seq=-1, timeout=None, consumer=None):
+        if self.sequence <= after_seq:
+            with self._cond:
+                self._waiters += 1
+                try:
+                    self._cond.wait_for(
+                        lambda: self.sequence > after_seq or not self._run,
+                        timeout
+                    )
+                finally:
+                    self._waiters -= 1
+            if self.sequence <= after_seq:
+                return None
+        return self.read(consumer)
+
+    # Newest Frame without holding it: only its metadata and the image
+    # shape are reliable, the pixels may be rewritten at any time
+    def peek(self):
+        if self._latest is None:
+            return None
+        return self._slots[self._latest]
+
+    # Copy of the newest image; the slot is released right away
     @property
     def frame(self):
-        # Copy may cause some problems about performance
-        # return self._frame
-        return np.copy(self._frame)
+        consumer = object()
+        frame = self.read(consumer)
+        try:
+            return np.copy(frame.image) if frame else None
+        finally:
+            self.release(consumer)
+
+    @property
+    def timestamp(self):
+        frame = self.peek()
+        return frame.timestamp if frame else 0.0
 
     @property
     def run(self):
-        return _run
+        return self._run
 
     @property
     def width(self):
-        return self._cap.get(cv2.CAP_PROP_FRAME_WIDTH)
+        frame = self.peek()
+        return frame.image.shape[1] if frame else 0
 
     @property
     def height(self):
-        return self._cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
+        frame = self.peek()
+        return frame.image.shape[0] if frame else 0
+
+    @property
+    def fourcc(self):
+        return ''
 
     def __enter__(self):
         self.start()
@@ -60,8 +377,357 @@ class Webcam:
 
     def __del__(self):
         self.stop()
+        self._close()
+
+
+class Webcam(VideoSource):
+
+    # convert_rgb: False delivers raw frames (e.g. YUYV/NV12) from the device
+    # fourcc: requested pixel format such as 'YUYV' or 'NV12'
+    def __init__(self, device=0, convert_rgb=True, fourcc=None, slots=3,
+                 realtime=True, steps=()):
+        super().__init__(slots=slots, realtime=realtime, steps=steps)
+        self._cap = cv2.VideoCapture(device)
+        if fourcc:
+            self._cap.set(
+                cv2.CAP_PROP_FOURCC,
+                cv2.VideoWriter_fourcc(*fourcc)
+            )
+        if not convert_rgb:
+            self._cap.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+        self._prime()
+
+    def _read_frame(self, image):
+        return self._cap.read(image=image)
+
+    def _close(self):
         self._cap.release()
 
+    # Raw formats deliver a buffer, not an image: ask the device
+    @property
+    def width(self):
+        return self._cap.get(cv2.CAP_PROP_FRAME_WIDTH)
+
+    @property
+    def height(self):
+        return self._cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
+
+    @property
+    def fourcc(self):
+        code = int(self._cap.get(cv2.CAP_PROP_FOURCC))
+        return ''.join([chr((code >> 8 * i) & 0xFF) for i in range(4)])
+
+
+class FileSource(VideoSource):
+
+    # path: any file cv2.VideoCapture can decode
+    # fps: None uses the rate stored in the file
+    # loop: rewind at the end instead of stopping
+    def __init__(self, path, fps=None, realtime=True, loop=False, slots=3,
+                 steps=()):
+        self._cap = cv2.VideoCapture(path)
+        if fps is None:
+            fps = self._cap.get(cv2.CAP_PROP_FPS) or 30.0
+        super().__init__(
+            slots=slots, fps=fps, realtime=realtime, steps=steps)
+        self.loop = loop
+        self._prime()
+
+    def _read_frame(self, image):
+        succeed, image = self._cap.read(image=image)
+        if not succeed and self.loop:
+            self._cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            succeed, image = self._cap.read(image=image)
+        return succeed, image
+
+    def _close(self):
+        self._cap.release()
+
+
+class ImageSequenceSource(VideoSource):
+
+    extensions = ('.bmp', '.jpeg', '.jpg', '.png', '.ppm', '.tif', '.tiff')
+
+    # path: directory of images, played in file name order
+    # preload: decode everything up front so decoding stays out of the
+    #   measurements
+    def __init__(self, path, fps=30.0, realtime=True, loop=False,
+                 preload=False, slots=3, steps=()):
+        super().__init__(
+            slots=slots, fps=fps, realtime=realtime, steps=steps)
+        self.loop = loop
+        self.paths = [
+            os.path.join(path, name) for name in sorted(os.listdir(path))
+            if os.path.splitext(name)[1].lower() in self.extensions
+        ]
+        self._images = None
+        if preload:
+            self._images = [cv2.imread(p) for p in self.paths]
+        self._index = 0
+        self._prime()
+
+    def _read_frame(self, image):
+        if self._index >= len(self.paths):
+            if not self.loop or not self.paths:
+                return False, image
+            self._index = 0
+
+        if self._images is not None:
+            decoded = self._images[self._index]
+        else:
+            decoded = cv2.imread(self.paths[self._index])
+        self._index += 1
+        if decoded is None:
+            return False, image
+        return True, _copy_into(image, decoded)
+
+
+class RawFrameSource(VideoSource):
+
+    # path: frames dumped back to back without headers
+    # shape: (height, width) or (height, width, channels) of one frame
+    def __init__(self, path, shape, dtype='uint8', fps=30.0, realtime=True,
+                 loop=False, slots=3, steps=()):
+        super().__init__(
+            slots=slots, fps=fps, realtime=realtime, steps=steps)
+        self.loop = loop
+        frame_size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        count = os.path.getsize(path) // frame_size
+        self._frames = np.memmap(
+            path,
+            dtype=dtype,
+            mode='r',
+            shape=(count,) + tuple(shape)
+        )
+        self._index = 0
+        self._prime()
+
+    def _read_frame(self, image):
+        if self._index >= len(self._frames):
+            if not self.loop or not len(self._frames):
+                return False, image
+            self._index = 0
+
+        # Pages come straight from the file cache, slots stay writable
+        image = _copy_into(image, self._frames[self._index])
+        self._index += 1
+        return True, image
+
+    def _close(self):
+        self._frames = None
+
+
+class SyntheticSource(VideoSource):
+
+    # Color bars with a box moving one step per frame, so every frame is
+    # different but reproducible
+    # frames: stop after this many frames, None runs forever
+    def __init__(self, width=1280, height=720, fps=30.0, realtime=True,
+                 frames=None, slots=3, steps=()):
+        super().__init__(
+            slots=slots, fps=fps, realtime=realtime, steps=steps)
+        self.frames = frames
+
+        colors = np.array(
+            [[192, 192, 192], [0, 192, 192], [192, 192, 0], [0, 192, 0],
+             [192, 0, 192], [0, 0, 192], [192, 0, 0], [16, 16, 16]],
+            dtype='uint8'
+        )
+        columns = np.arange(width) * len(colors) // width
+        self._bars = np.ascontiguousarray(
+            np.broadcast_to(colors[columns], (height, width, 3)))
+        self._box = max(height // 8, 1)
+        self._count = 0
+        self._prime()
+
+    def _read_frame(self, image):
+        if self.frames is not None and self._count >= self.frames:
+            return False, image
+
+        image = _copy_into(image, self._bars)
+        h, w = image.shape[:2]
+        step = self._count * 8
+        x = step % max(w - self._box, 1)
+        y = (step // 3) % max(h - self._box, 1)
+        image[y:y + self._box, x:x + self._box] = 255
+        self._count += 1
+        return True, image
+
+
+class FrameSet:
+
+    # frames: one Frame (or None) per source
+    # timestamp: capture time the frames were aligned to
+    # stale: per source, True when no frame was within the tolerance
+    def __init__(self, frames, timestamp, stale):
+        self.frames = frames
+        self.timestamp = timestamp
+        self.stale = stale
+
+    @property
+    def complete(self):
+        return not any(self.stale)
+
+
+class CaptureManager:
+
+    # sources: VideoSource objects, each captures on its own thread
+    # tolerance: largest skew in seconds for a frame to count as aligned
+    # max_lag: sources whose newest frame is this much older than the
+    #   newest overall are left out of the reference so they cannot hold
+    #   the others back
+    def __init__(self, sources, tolerance=1.0 / 60, max_lag=0.1):
+        self.sources = list(sources)
+        self.tolerance = tolerance
+        self.max_lag = max_lag
+        self.current = None
+        self.sets = 0
+
+        self._consumer = ('capture', id(self))
+        self._last_seq = [None] * len(self.sources)
+        self._stats = [
+            {'frames': 0, 'drops': 0, 'repeats': 0, 'stale': 0,
+             'skew_sum': 0.0, 'skew_max': 0.0}
+            for _ in self.sources
+        ]
+
+    def start(self):
+        for source in self.sources:
+            source.start()
+
+    def stop(self):
+        for source in self.sources:
+            source.stop()
+            source.release(self._consumer)
+
+    # Align the sources and return a new FrameSet. The frames stay valid
+    # until the next call.
+    def read(self):
+        newest = [source.timestamp for source in self.sources]
+        if not any(newest):
+            return None
+
+        # The oldest of the live sources: everybody else can find a frame
+        # near it in their ring, nobody has to wait for a future frame
+        latest = max(newest)
+        live = [t for t in newest if t and latest - t <= self.max_lag]
+        reference = min(live)
+
+        frames = []
+        stale = []
+        for i, source in enumerate(self.sources):
+            frame = source.nearest(reference, self._consumer)
+            frames.append(frame)
+            stale.append(self._account(i, frame, reference))
+
+        self.sets += 1
+        self.current = FrameSet(frames, reference, stale)
+        return self.current
+
+    def _account(self, index, frame, reference):
+        stats = self._stats[index]
+        if frame is None:
+            stats['stale'] += 1
+            return True
+
+        last = self._last_seq[index]
+        if last is not None:
+            if frame.seq == last:
+                stats['repeats'] += 1
+            elif frame.seq > last + 1:
+                stats['drops'] += frame.seq - last - 1
+        self._last_seq[index] = frame.seq
+
+        skew = abs(frame.timestamp - reference)
+        stats['frames'] += 1
+        stats['skew_sum'] += skew
+        stats['skew_max'] = max(stats['skew_max'], skew)
+        if skew > self.tolerance:
+            stats['stale'] += 1
+            return True
+        return False
+
+    # Per source: frames used, frames never shown, frames shown twice,
+    # sets it missed the tolerance and skew in milliseconds
+    @property
+    def stats(self):
+        result = []
+        for stats in self._stats:
+            frames = max(stats['frames'], 1)
+            result.append({
+                'frames': stats['frames'],
+                'drops': stats['drops'],
+                'repeats': stats['repeats'],
+                'stale': stats['stale'],
+                'skew_mean': stats['skew_sum'] / frames * 1e3,
+                'skew_max': stats['skew_max'] * 1e3,
+            })
+        return result
+
+    # VideoSource-like view of one source inside the current FrameSet
+    def channel(self, index):
+        return CaptureChannel(self, index)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
+
+
+class CaptureChannel:
+
+    def __init__(self, manager, index):
+        self.manager = manager
+        self.index = index
+        self.source = manager.sources[index]
+
+    # The frame is held by the manager until its next read()
+    def read(self, consumer=None):
+        current = self.manager.current
+        return current.frames[self.index] if current else None
+
+    def release(self, consumer=None):
+        pass
+
+    @property
+    def frame(self):
+        frame = self.read()
+        return frame.image if frame else None
+
+    # Sequence of the frame served, not the newest one of the source:
+    # a tile is clean once it shows the aligned frame
+    @property
+    def sequence(self):
+        frame = self.read()
+        return frame.seq if frame else -1
+
+    @property
+    def frame_listeners(self):
+        return self.source.frame_listeners
+
+    @property
+    def width(self):
+        return self.source.width
+
+    @property
+    def height(self):
+        return self.source.height
+
+    @property
+    def fourcc(self):
+        return self.source.fourcc
+
+
+# Reuse the slot buffer when the frame fits, reallocate otherwise
+def _copy_into(image, source):
+    if image is None or image.shape != source.shape or \
+            image.dtype != source.dtype:
+        return np.array(source)
+    np.copyto(image, source)
+    return image
+
 
 class FPSChecker:
 
@@ -108,3 +774,373 @@ class FPSChecker:
             self.draw(frame)
 
         return self.fps
+
+
+class FrameTimer:
+
+    # capacity: frames kept for the statistics
+    # budget: frame time target in seconds
+    def __init__(self, capacity=240, budget=1.0 / 60):
+        self.budget = budget
+        self.count = 0
+
+        self._times = np.zeros(capacity, dtype='float64')
+        self._last = None
+
+    # Call once per frame, returns the last frame time in seconds
+    def lab(self):
+        now = time.perf_counter()
+        dt = 0.0
+        if self._last is not None:
+            dt = now - self._last
+            self._times[self.count % self._times.size] = dt
+            self.count += 1
+        self._last = now
+        return dt
+
+    @property
+    def capacity(self):
+        return self._times.size
+
+    # Frame times in seconds, oldest first
+    @property
+    def samples(self):
+        n = min(self.count, self._times.size)
+        if self.count <= self._times.size:
+            return self._times[:n]
+        i = self.count % self._times.size
+        return np.concatenate((self._times[i:], self._times[:i]))
+
+    @property
+    def fps(self):
+        samples = self.samples
+        if samples.size == 0:
+            return 0.0
+        return 1.0 / samples.mean()
+
+    # Frame times in milliseconds
+    def stats(self):
+        samples = self.samples * 1e3
+        if samples.size == 0:
+            return {}
+
+        p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+        return {
+            'fps': float(1e3 / samples.mean()),
+            'mean': float(samples.mean()),
+            'p50': float(p50),
+            'p95': float(p95),
+            'p99': float(p99),
+            'jitter': float(samples.std()),
+            'longest': float(samples.max()),
+            'over_budget': int(np.count_nonzero(
+                samples > self.budget * 1e3)),
+        }
+
+
+class VideoRecorder:
+
+    # path: output file written with cv2.VideoWriter
+    # command: encoder process reading bgr24 frames on stdin instead, e.g.
+    #   ['ffmpeg', '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s',
+    #    '{width}x{height}', '-r', '{fps}', '-i', '-', 'out.mp4']
+    # policy: 'drop' discards frames while the queue is full, 'block' waits
+    # rgb/flip: frames are RGB and bottom-up (as read back from GL)
+    def __init__(self, path=None, fps=30.0, fourcc='mp4v', command=None,
+                 queue_size=8, policy='drop', rgb=True, flip=True):
+        if policy not in ('drop', 'block'):
+            raise ValueError('unknown policy: {}'.format(policy))
+
+        self.path = path
+        self.fps = fps
+        self.fourcc = fourcc
+        self.command = command
+        self.policy = policy
+        self.rgb = rgb
+        self.flip = flip
+
+        self.encoded = 0
+        self.dropped = 0
+        # Exception that stopped the encoder, frames are refused after it
+        self.error = None
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._writer = None
+        self._process = None
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target=self._encode_loop, args=())
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        # The encoder may have died with a full queue, never block on it
+        self._offer(None)
+        self._thread.join()
+        self._thread = None
+        self._close()
+
+    # Returns False when the frame is dropped or the encoder has failed
+    def put(self, frame):
+        if self.error is not None or not self._running():
+            self.dropped += 1
+            return False
+
+        if self.policy == 'block':
+            if self._offer(frame):
+                return True
+            self.dropped += 1
+            return False
+
+        try:
+            self._queue.put_nowait(frame)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    # Started and not yet exited (frames queued before start() are kept)
+    def _running(self):
+        return self._thread is None or self._thread.is_alive()
+
+    # Blocking put that gives up once the encoder thread exits
+    def _offer(self, item):
+        while self._running():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    @property
+    def stats(self):
+        return {
+            'encoded': self.encoded,
+            'dropped': self.dropped,
+            'queued': self._queue.qsize(),
+        }
+
+    def _open(self, width, height):
+        if self.command:
+            args = [arg.format(width=width, height=height, fps=self.fps)
+                    for arg in self.command]
+            self._process = subprocess.Popen(args, stdin=subprocess.PIPE)
+        else:
+            self._writer = cv2.VideoWriter(
+                self.path,
+                cv2.VideoWriter_fourcc(*self.fourcc),
+                self.fps,
+                (width, height)
+            )
+
+    def _close(self):
+        if self._writer is not None:
+            self._writer.release()
+            self._writer = None
+        if self._process is not None:
+            try:
+                self._process.stdin.close()
+            except OSError:
+                pass
+            self._process.wait()
+            self._process = None
+
+    def _encode_loop(self):
+        try:
+            self._encode_frames()
+        except Exception as e:
+            # e.g. the encoder command is missing or exited (broken pipe)
+            print('VideoRecorder failed: {}'.format(e))
+            self.error = e
+
+        # Release anyone blocked on a full queue
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+
+    def _encode_frames(self):
+        while True:
+            frame = self._queue.get()
+            if frame is None:
+                break
+
+            if self.flip:
+                frame = cv2.flip(frame, 0)
+            if self.rgb:
+                frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+
+            if self._writer is None and self._process is None:
+                self._open(frame.shape[1], frame.shape[0])
+
+            if self._process is not None:
+                self._process.stdin.write(frame.tobytes())
+            else:
+                self._writer.write(frame)
+            self.encoded += 1
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
+
+
+class AsyncProcessor:
+
+    # process: callable(Frame) -> result, run on the worker threads
+    # workers: worker thread count
+    # max_in_flight: frames queued or being processed at once; when full,
+    #   the oldest queued frame makes room for the new one
+    # history: results kept for the latency statistics
+    # variants, copy_image: what submit() copies out of the ring slot on
+    #   the caller's thread (see Frame.copy); hand over only what process
+    #   reads, e.g. variants=('gray', 'gray_scale'), copy_image=False
+    def __init__(self, process, workers=1, max_in_flight=2, history=120,
+                 variants=None, copy_image=True):
+        self.process = process
+        self.workers = max(workers, 1)
+        self.max_in_flight = max(max_in_flight, 1)
+        self.variants = variants
+        self.copy_image = copy_image
+
+        self.submitted = 0
+        self.processed = 0
+        self.dropped = 0
+
+        # Called from a worker thread after every completed result
+        self.result_listeners = []
+
+        self._pending = collections.deque()
+        self._busy = 0
+        self._cond = Condition()
+        self._run = False
+        self._threads = []
+
+        self._result = None
+        self._result_seq = -1
+        self._latency = collections.deque(maxlen=history)
+        self._duration = collections.deque(maxlen=history)
+
+    def start(self):
+        self._run = True
+        self._threads = [
+            Thread(target=self._work_loop, args=())
+            for _ in range(self.workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._run = False
+            self.dropped += len(self._pending)
+            self._pending.clear()
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    # Queue a frame, copied so the ring slot can be reused right away.
+    # Returns False when the frame is dropped.
+    def submit(self, frame):
+        with self._cond:
+            self.submitted += 1
+            while self._pending and \
+                    self._busy + len(self._pending) >= self.max_in_flight:
+                self._pending.popleft()
+                self.dropped += 1
+            if self._busy >= self.max_in_flight:
+                # Every slot is being processed, nothing left to replace
+                self.dropped += 1
+                return False
+
+        job = (
+            frame.copy(self.variants, self.copy_image),
+            time.perf_counter()
+        )
+        with self._cond:
+            self._pending.append(job)
+            self._cond.notify()
+        return True
+
+    def _work_loop(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending or not self._run)
+                if not self._run:
+                    return
+                frame, submitted = self._pending.popleft()
+                self._busy += 1
+
+            failed = False
+            try:
+                with span('process'):
+                    result = self.process(frame)
+            except Exception as e:
+                print('processing frame {} failed: {}'.format(frame.seq, e))
+                failed = True
+
+            done = time.perf_counter()
+            with self._cond:
+                self._busy -= 1
+                if failed:
+                    continue
+                self.processed += 1
+                self._latency.append(done - frame.timestamp)
+                self._duration.append(done - submitted)
+                # Workers may finish out of order; keep the newest frame's
+                if frame.seq > self._result_seq:
+                    self._result = result
+                    self._result_seq = frame.seq
+            for listener in self.result_listeners:
+                listener()
+
+    # Most recent completed result, None until the first one
+    @property
+    def result(self):
+        return self._result
+
+    # Sequence number of the frame the result belongs to
+    @property
+    def result_seq(self):
+        return self._result_seq
+
+    @property
+    def in_flight(self):
+        return self._busy + len(self._pending)
+
+    # latency: capture to result, process: submit to result, milliseconds
+    def stats(self):
+        with self._cond:
+            latency = np.array(self._latency) * 1e3
+            duration = np.array(self._duration) * 1e3
+
+        stats = {
+            'submitted': self.submitted,
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'in_flight': self.in_flight,
+        }
+        if latency.size:
+            p50, p95, p99 = np.percentile(latency, [50, 95, 99])
+            stats.update({
+                'latency_p50': float(p50),
+                'latency_p95': float(p95),
+                'latency_p99': float(p99),
+                'latency_max': float(latency.max()),
+                'process_mean': float(duration.mean()),
+            })
+        return stats
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
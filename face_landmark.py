@@ -15,6 +15,7 @@ from matplotlib import patches
 from os.path import split
 from renderer import *
 from threading import Timer
+from tracing import span
 
 
 verbose = False
@@ -25,14 +26,112 @@ def debug(msg):
         print(msg)
 
 
+class Track:
+
+    def __init__(self, track_id, gray, rect):
+        self.id = track_id
+        self.tracker = dlib.correlation_tracker()
+        self.tracker.start_track(gray, rect)
+        self.rect = rect
+        self.confidence = float('inf')
+
+    # Follow the face into gray, returns the peak-to-sidelobe ratio
+    def update(self, gray):
+        self.confidence = self.tracker.update(gray)
+        pos = self.tracker.get_position()
+        self.rect = dlib.rectangle(
+            int(pos.left()), int(pos.top()),
+            int(pos.right()), int(pos.bottom())
+        )
+        return self.confidence
+
+
+def _iou(a, b):
+    left = max(a.left(), b.left())
+    top = max(a.top(), b.top())
+    right = min(a.right(), b.right())
+    bottom = min(a.bottom(), b.bottom())
+    if right <= left or bottom <= top:
+        return 0.0
+    inter = (right - left) * (bottom - top)
+    union = a.width() * a.height() + b.width() * b.height() - inter
+    return inter / union if union > 0 else 0.0
+
+
 class FaceDetector:
 
-    def __init__(self, resize_width=512):
+    # tracking: run the HOG detector only every detect_interval frames and
+    #   follow the faces with correlation trackers in between. Frames have
+    #   to arrive in order, so use a single worker.
+    # min_confidence: tracker peak-to-sidelobe ratio below which a face
+    #   counts as lost and the next frame runs a full detection
+    def __init__(self, resize_width=512, tracking=False, detect_interval=10,
+                 min_confidence=7.0, match_iou=0.3):
         predictor_path = downloader.check_model()
         self.detector = dlib.get_frontal_face_detector()
         self.predictor = dlib.shape_predictor(predictor_path)
         self.width = int(resize_width)
 
+        self.tracking = tracking
+        self.detect_interval = max(int(detect_interval), 1)
+        self.min_confidence = min_confidence
+        self.match_iou = match_iou
+
+        self.tracks = []
+        self.detections = 0
+        self.tracked = 0
+        self._since_detection = 0
+        self._next_id = 0
+
+    # Track ids of the faces returned by the last detect()
+    @property
+    def track_ids(self):
+        return [t.id for t in self.tracks]
+
+    def reset_tracks(self):
+        self.tracks = []
+        self._since_detection = 0
+
+    def _find_faces(self, gray):
+        if not self.tracking:
+            self.detections += 1
+            return self.detector(gray, 1)
+
+        if self.tracks and self._since_detection < self.detect_interval:
+            with span('detect.track'):
+                confidences = [t.update(gray) for t in self.tracks]
+            if min(confidences) >= self.min_confidence:
+                self._since_detection += 1
+                self.tracked += 1
+                return [t.rect for t in self.tracks]
+            debug('track lost, confidence {:.1f}'.format(min(confidences)))
+
+        self.detections += 1
+        self._since_detection = 1
+        rects = self.detector(gray, 1)
+        self.tracks = self._match_tracks(gray, rects)
+        return [t.rect for t in self.tracks]
+
+    # Carry track ids over to the new detections by overlap
+    def _match_tracks(self, gray, rects):
+        previous = list(self.tracks)
+        tracks = []
+        for rect in rects:
+            best, best_iou = None, self.match_iou
+            for track in previous:
+                iou = _iou(track.rect, rect)
+                if iou >= best_iou:
+                    best, best_iou = track, iou
+
+            if best is not None:
+                previous.remove(best)
+                track_id = best.id
+            else:
+                track_id = self._next_id
+                self._next_id += 1
+            tracks.append(Track(track_id, gray, rect))
+        return tracks
+
     def get_landmarks(self, image, bboxes):
         landmarks = np.array(
             [[[p.x, p.y]
@@ -41,16 +140,27 @@ class FaceDetector:
         )
         return landmarks
 
-    def detect(self, image):
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    # gray: detection-sized grayscale copy of image, e.g. the 'gray'
+    # variant made by cvutils.DetectionGray on the capture thread
+    # scale: gray width / image width; with it image may be None
+    def detect(self, image, gray=None, scale=None):
+        if gray is not None:
+            if scale is None:
+                scale = gray.shape[1] / image.shape[1]
+        else:
+            with span('detect.preprocess'):
+                gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
 
-        self.width = min(self.width, image.shape[1])
-        scale = self.width / image.shape[1]
-        dsize = (self.width, int(image.shape[0] * scale))
-        gray = cv2.resize(gray, dsize=dsize)
+                self.width = min(self.width, image.shape[1])
+                scale = self.width / image.shape[1]
+                dsize = (self.width, int(image.shape[0] * scale))
+                gray = cv2.resize(gray, dsize=dsize)
 
-        rects = self.detector(gray, 1)
-        landmarks = self.get_landmarks(gray, rects)
+        with span('detect.faces'):
+            rects = self._find_faces(gray)
+        # The shape predictor only looks inside the (tracked) boxes
+        with span('detect.landmarks'):
+            landmarks = self.get_landmarks(gray, rects)
 
         for (i, rect) in enumerate(rects):
             left = int(rect.left() / scale)
@@ -68,6 +178,14 @@ class FaceDetector:
         self.landmarks = landmarks
         return self.rects, self.landmarks
 
+    # Detect on a cvutils.Frame, using its precomputed gray variant if any
+    def detect_frame(self, frame):
+        return self.detect(
+            frame.image,
+            frame.variants.get('gray'),
+            frame.variants.get('gray_scale')
+        )
+
 
 def help():
     def filename_of(path):
@@ -1,7 +1,16 @@
+import collections
 import ctypes
+import hashlib
+import json
 import numpy as np
+import os
+import struct
 
+from concurrent.futures import Future
 from OpenGL.GL import *
+from OpenGL.error import GLError
+from OpenGL.raw.GL.VERSION.GL_3_3 import \
+    glGetQueryObjectui64v as _glGetQueryObjectui64v
 from PIL import Image
 
 from glutils import *
@@ -15,48 +24,510 @@ def debug(msg):
         print(msg)
 
 
+class GLState:
+
+    # strict: reset bindings to 0 when leaving a `with` block
+    def __init__(self, strict=False):
+        self.strict = strict
+        self.issued = 0
+        self.elided = 0
+        self.invalidate()
+
+    # Forget everything, e.g. after foreign code touched the bindings
+    def invalidate(self):
+        self.program = None
+        self.vertex_array = None
+        self.active_unit = None
+        self.textures = {}
+        self.framebuffer = None
+        self.viewport = None
+
+    # Framebuffer that stands for the screen (an FBO when headless)
+    default_framebuffer = 0
+
+    def reset_counters(self):
+        self.issued = 0
+        self.elided = 0
+
+    @property
+    def stats(self):
+        return {'issued': self.issued, 'elided': self.elided}
+
+    def use_program(self, program):
+        if self.program == program:
+            self.elided += 1
+            return
+        glUseProgram(program)
+        self.program = program
+        self.issued += 1
+
+    def bind_vertex_array(self, vertex_array):
+        if self.vertex_array == vertex_array:
+            self.elided += 1
+            return
+        glBindVertexArray(vertex_array)
+        self.vertex_array = vertex_array
+        self.issued += 1
+
+    def active_texture(self, unit):
+        if self.active_unit == unit:
+            self.elided += 1
+            return
+        glActiveTexture(unit)
+        self.active_unit = unit
+        self.issued += 1
+
+    # The unit is activated even when the bind is elided: uploads that
+    # follow go to the active unit's binding
+    def bind_texture(self, unit, target, texture):
+        self.active_texture(unit)
+        key = (unit, target)
+        if self.textures.get(key) == texture:
+            self.elided += 1
+            return
+        glBindTexture(target, texture)
+        self.textures[key] = texture
+        self.issued += 1
+
+    def bind_framebuffer(self, framebuffer):
+        if self.framebuffer == framebuffer:
+            self.elided += 1
+            return
+        glBindFramebuffer(GL_FRAMEBUFFER, framebuffer)
+        self.framebuffer = framebuffer
+        self.issued += 1
+
+    def set_viewport(self, x, y, width, height):
+        viewport = (x, y, width, height)
+        if self.viewport == viewport:
+            return
+        glViewport(x, y, width, height)
+        self.viewport = viewport
+
+    def get_viewport(self):
+        if self.viewport is None:
+            self.viewport = tuple(
+                [int(v) for v in glGetIntegerv(GL_VIEWPORT)])
+        return self.viewport
+
+    def release_program(self):
+        if self.strict:
+            self.use_program(0)
+
+    def release_vertex_array(self):
+        if self.strict:
+            self.bind_vertex_array(0)
+
+    def release_texture(self, unit, target):
+        if self.strict:
+            self.bind_texture(unit, target, 0)
+
+    # Call before deleting objects so a recycled name is not seen as bound
+    def forget_program(self, program):
+        if self.program == program:
+            self.use_program(0)
+
+    def forget_vertex_array(self, vertex_array):
+        if self.vertex_array == vertex_array:
+            self.vertex_array = 0
+
+    def forget_texture(self, texture):
+        for key, value in self.textures.items():
+            if value == texture:
+                self.textures[key] = 0
+
+    def forget_framebuffer(self, framebuffer):
+        if self.framebuffer == framebuffer:
+            self.bind_framebuffer(self.default_framebuffer)
+
+
+_states = {}
+_state = GLState()
+
+
+# State tracker of the current context
+def gl_state():
+    return _state
+
+
+# Call whenever the context identified by key is made current
+def make_state_current(key):
+    global _state
+    _state = _states.get(key)
+    if _state is None:
+        _state = _states[key] = GLState()
+    return _state
+
+
+def release_state(key):
+    _states.pop(key, None)
+
+
 class Program:
 
-    def __init__(self, vs_code, fs_code, gs_code=None):
+    def __init__(self, vs_code, fs_code, gs_code=None, binary_cache=None):
+        self._id = -1
+        sources = (vs_code, fs_code, gs_code)
+        if binary_cache:
+            self._id = binary_cache.load(sources)
+
+        if self._id <= 0:
+            self._id = self._compile(sources, binary_cache)
+
+        self.uniforms = {}
+        self.attributes = {}
+        self._uniform_values = {}
+        if self._id > 0:
+            self._reflect()
+
+    def __del__(self):
+        if self._id > 0:
+            gl_state().forget_program(self._id)
+            glDeleteProgram(self._id)
+
+    def _compile(self, sources, binary_cache=None):
+        vs_code, fs_code, gs_code = sources
         shaders = []
         shaders.append(create_shader(GL_VERTEX_SHADER, vs_code))
         shaders.append(create_shader(GL_FRAGMENT_SHADER, fs_code))
         if gs_code:
             shaders.append(create_shader(GL_GEOMETRY_SHADER, gs_code))
 
-        self._id = create_program(shaders)
+        program = create_program(
+            shaders,
+            retrievable=binary_cache is not None
+        )
 
         for shader in shaders:
             glDeleteShader(shader)
 
-    def __del__(self):
-        if self._id > 0:
-            glDeleteProgram(self._id)
+        if binary_cache and program > 0:
+            binary_cache.store(sources, program)
+
+        return program
 
     def __enter__(self):
-        glUseProgram(self._id)
+        self.bind()
         return self
 
+    @property
+    def id(self):
+        return self._id
+
+    def bind(self):
+        gl_state().use_program(self._id)
+
     def __exit__(self, exc_type, exc_value, tb):
-        glUseProgram(0)
+        gl_state().release_program()
+
+    # Query active uniforms and attributes once, right after linking
+    def _reflect(self):
+        count = glGetProgramiv(self._id, GL_ACTIVE_UNIFORMS)
+        for i in range(count):
+            name, size, type_ = glGetActiveUniform(self._id, i)
+            name = _variable_name(name)
+            location = glGetUniformLocation(self._id, name)
+            self.uniforms[name] = Variable(location, size, type_)
+
+        count = glGetProgramiv(self._id, GL_ACTIVE_ATTRIBUTES)
+        for i in range(count):
+            name, size, type_ = glGetActiveAttrib(self._id, i)
+            name = _variable_name(name)
+            location = glGetAttribLocation(self._id, name)
+            self.attributes[name] = Variable(location, size, type_)
+
+        debug('program {} uniforms: {}, attributes: {}'.format(
+            self._id, list(self.uniforms), list(self.attributes)))
+
+    def uniform_location(self, name):
+        variable = self.uniforms.get(name)
+        if variable is None:
+            return -1
+        return variable.location
+
+    def attribute_location(self, name):
+        variable = self.attributes.get(name)
+        if variable is None:
+            return -1
+        return variable.location
+
+    # Uploads only when the value differs from the last one sent
+    def _set(self, name, value, upload):
+        location = self.uniform_location(name)
+        if location < 0:
+            return
+
+        cached = self._uniform_values.get(location)
+        if cached is not None and \
+           cached.shape == value.shape and \
+           np.array_equal(cached, value):
+            return
+
+        self._uniform_values[location] = np.array(value, copy=True)
+        upload(location, value)
 
     def setInt(self, name, value):
-        glUniform1i(glGetUniformLocation(self._id, name), value)
+        self._set(name, np.asarray(value, dtype='int32'),
+                  lambda loc, v: glUniform1i(loc, int(v)))
 
     def setFloat(self, name, value):
-        glUniform1f(glGetUniformLocation(self._id, name), value)
+        self._set(name, np.asarray(value, dtype='float32'),
+                  lambda loc, v: glUniform1f(loc, float(v)))
+
+    def setSampler(self, name, unit_number):
+        self.setInt(name, unit_number)
+
+    def setIntArray(self, name, value):
+        value = np.asarray(value, dtype='int32').ravel()
+        self._set(name, value,
+                  lambda loc, v: glUniform1iv(loc, v.size, v))
+
+    def setFloatArray(self, name, value):
+        value = np.asarray(value, dtype='float32').ravel()
+        self._set(name, value,
+                  lambda loc, v: glUniform1fv(loc, v.size, v))
+
+    def setVec2f(self, name, value):
+        value = np.asarray(value, dtype='float32').ravel()
+        self._set(name, value,
+                  lambda loc, v: glUniform2fv(loc, v.size // 2, v))
+
+    def setVec3f(self, name, value):
+        value = np.asarray(value, dtype='float32').ravel()
+        self._set(name, value,
+                  lambda loc, v: glUniform3fv(loc, v.size // 3, v))
 
     def setVec4f(self, name, value):
-        count = int(value.shape[0] / 4)
-        glUniform4fv(glGetUniformLocation(self._id, name), count, value)
+        value = np.asarray(value, dtype='float32').ravel()
+        self._set(name, value,
+                  lambda loc, v: glUniform4fv(loc, v.size // 4, v))
+
+    # value is row-major unless transpose is False
+    def setMat3f(self, name, value, transpose=True):
+        value = np.asarray(value, dtype='float32').ravel()
+        self._set(name, value,
+                  lambda loc, v: glUniformMatrix3fv(
+                      loc, v.size // 9, transpose, v))
+
+    def setMat4f(self, name, value, transpose=True):
+        value = np.asarray(value, dtype='float32').ravel()
+        self._set(name, value,
+                  lambda loc, v: glUniformMatrix4fv(
+                      loc, v.size // 16, transpose, v))
+
+
+class ProgramBinaryCache:
+
+    # Each entry is a small header (binary format) followed by the blob
+    _header = struct.Struct('<I')
+
+    def __init__(self, dirpath='./cache'):
+        self.dirpath = dirpath
+        # GLState of each context -> (supported, driver signature), the
+        # contexts of one process may come from different drivers
+        self._contexts = {}
+
+    def _context(self):
+        state = gl_state()
+        entry = self._contexts.get(state)
+        if entry is None:
+            try:
+                entry = (supports_program_binary(), driver_signature())
+            except Exception as e:
+                debug('program binary is not available: {}'.format(e))
+                entry = (False, None)
+            self._contexts[state] = entry
+        return entry
+
+    def _available(self):
+        return self._context()[0]
+
+    def path_of(self, sources):
+        digest = hashlib.sha1()
+        digest.update(self._context()[1].encode())
+        for code in sources:
+            digest.update(b'\0')
+            if code:
+                digest.update(code.encode())
+        return os.path.join(self.dirpath, digest.hexdigest() + '.bin')
+
+    def load(self, sources):
+        if not self._available():
+            return -1
+
+        path = self.path_of(sources)
+        if not os.path.isfile(path):
+            return -1
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) <= self._header.size:
+            return -1
+
+        binary_format, = self._header.unpack_from(data)
+        try:
+            program = load_program_binary(
+                binary_format,
+                data[self._header.size:]
+            )
+        except GLError as e:
+            debug('glProgramBinary failed: error 0x{:04x}'.format(e.err))
+            program = -1
+        if program <= 0:
+            # Driver update or corrupted entry: recompile and overwrite
+            debug('program binary is rejected: {}'.format(path))
+            os.remove(path)
+
+        return program
+
+    def store(self, sources, program):
+        if not self._available():
+            return
+
+        binary_format, binary = get_program_binary(program)
+        if not binary:
+            return
+
+        if not os.path.exists(self.dirpath):
+            os.makedirs(self.dirpath)
+
+        path = self.path_of(sources)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(self._header.pack(binary_format))
+            f.write(binary)
+        os.replace(temp_path, path)
+        debug('program binary is stored: {}'.format(path))
+
+
+default_binary_cache = ProgramBinaryCache()
+
+
+class Variable:
+
+    def __init__(self, location, size, type_):
+        self.location = location
+        self.size = size
+        self.type = type_
+
+    def __repr__(self):
+        return 'Variable(location={}, size={}, type={})'.format(
+            self.location, self.size, self.type)
+
+
+# Array uniforms are reported as 'name[0]'
+def _variable_name(name):
+    if isinstance(name, bytes):
+        name = name.decode()
+    if name.endswith('[0]'):
+        name = name[:-3]
+    return name
+
+
+_index_types = {
+    np.dtype('uint8'): GL_UNSIGNED_BYTE,
+    np.dtype('uint16'): GL_UNSIGNED_SHORT,
+    np.dtype('uint32'): GL_UNSIGNED_INT,
+}
+
+
+class Buffer:
+
+    # usage: GL_STATIC_DRAW, GL_DYNAMIC_DRAW or GL_STREAM_DRAW
+    def __init__(self, target, data=None, usage=GL_STATIC_DRAW):
+        self.target = target
+        self.usage = usage
+        self.capacity = 0
+        self.size = 0
+        self._id = glGenBuffers(1)
+
+        if data is not None:
+            glBindBuffer(self.target, self._id)
+            self.write(data)
+            glBindBuffer(self.target, 0)
+
+    def __del__(self):
+        if self._id is not None:
+            glDeleteBuffers(1, np.array([self._id]))
+
+    def __enter__(self):
+        glBindBuffer(self.target, self._id)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        glBindBuffer(self.target, 0)
+
+    @property
+    def id(self):
+        return self._id
+
+    # Buffer must be bound. Grows geometrically and keeps the first
+    # `preserve` bytes, so the name (and VAO bindings) stay valid.
+    def reserve(self, nbytes, preserve=0):
+        if nbytes <= self.capacity:
+            return
+
+        capacity = max(nbytes, self.capacity * 2)
+        preserve = min(preserve, self.size)
+
+        temp = None
+        if preserve > 0:
+            temp = glGenBuffers(1)
+            glBindBuffer(GL_COPY_WRITE_BUFFER, temp)
+            glBufferData(GL_COPY_WRITE_BUFFER, preserve, None, GL_STREAM_COPY)
+            glBindBuffer(GL_COPY_READ_BUFFER, self._id)
+            glCopyBufferSubData(
+                GL_COPY_READ_BUFFER, GL_COPY_WRITE_BUFFER, 0, 0, preserve)
+
+        glBufferData(self.target, capacity, None, self.usage)
+
+        if temp is not None:
+            glBindBuffer(GL_COPY_READ_BUFFER, temp)
+            glBindBuffer(GL_COPY_WRITE_BUFFER, self._id)
+            glCopyBufferSubData(
+                GL_COPY_READ_BUFFER, GL_COPY_WRITE_BUFFER, 0, 0, preserve)
+            glBindBuffer(GL_COPY_READ_BUFFER, 0)
+            glBindBuffer(GL_COPY_WRITE_BUFFER, 0)
+            glDeleteBuffers(1, np.array([temp]))
+
+        self.capacity = capacity
+        debug('buffer {} is reallocated ({} bytes)'.format(self._id, capacity))
+
+    # Buffer must be bound.
+    # offset is None: replace the whole contents (orphaning the old store)
+    # offset in bytes: update the given range only
+    def write(self, data, offset=None):
+        data = np.ascontiguousarray(data)
+        if offset is None:
+            if data.nbytes > self.capacity:
+                self.reserve(data.nbytes)
+            else:
+                # Orphan: the driver hands out fresh storage instead of
+                # waiting for draws that still read the old one
+                glBufferData(self.target, self.capacity, None, self.usage)
+            self.size = data.nbytes
+            offset = 0
+        else:
+            end = offset + data.nbytes
+            self.reserve(end, preserve=offset)
+            self.size = max(self.size, end)
+
+        if data.nbytes > 0:
+            glBufferSubData(self.target, offset, data.nbytes, data)
 
 
 class VertexObject:
 
     # vertices: float numpy array (1d)
     # alignment: int Python array
-    # indices: uint8 numpy array
-    def __init__(self, vertices, alignment, indices=None):
+    # indices: uint8/uint16/uint32 numpy array
+    # usage: GL_STATIC_DRAW, GL_DYNAMIC_DRAW or GL_STREAM_DRAW
+    # instances: float numpy array (1d) of per-instance attributes laid
+    #   out by instance_alignment, placed after the per-vertex locations
+    def __init__(self, vertices, alignment, indices=None,
+                 usage=GL_STATIC_DRAW,
+                 instances=None, instance_alignment=None,
+                 instance_usage=GL_DYNAMIC_DRAW):
         total = 0
         for part in alignment:
             total = total + part
@@ -68,119 +539,1089 @@ class VertexObject:
 
         self._size = vertices.size
         self._stride = total
+        self._alignment = alignment
         self._attribute_count = len(alignment)
+        self._usage = usage
         self.v_count = int(vertices.size / self._stride)
+        self.index_type = GL_UNSIGNED_BYTE
 
         self._vao = glGenVertexArrays(1)
-        glBindVertexArray(self._vao)
+        gl_state().bind_vertex_array(self._vao)
 
         self._ebo = None
         if indices is not None and indices.size > 0:
             self.count = indices.size
-            self._ebo = glGenBuffers(1)
-            glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self._ebo)
-            glBufferData(
-                GL_ELEMENT_ARRAY_BUFFER,
-                indices,
-                GL_STATIC_DRAW
-            )
+            self.index_type = _index_types[indices.dtype]
+            self._ebo = Buffer(GL_ELEMENT_ARRAY_BUFFER, usage=usage)
+            glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self._ebo.id)
+            self._ebo.write(indices)
         else:
             self.count = self.v_count
 
-        self._vbo = glGenBuffers(1)
-        glBindBuffer(GL_ARRAY_BUFFER, self._vbo)
-        glBufferData(
-            GL_ARRAY_BUFFER,
-            vertices,
-            GL_STATIC_DRAW
-        )
+        self._vbo = Buffer(GL_ARRAY_BUFFER, usage=usage)
+        glBindBuffer(GL_ARRAY_BUFFER, self._vbo.id)
+        self._vbo.write(vertices)
+        _set_attributes(alignment, 0)
 
-        for i in range(self._attribute_count):
-            glVertexAttribPointer(
-                i,
-                alignment[i],
-                GL_FLOAT,
-                False,
-                self._stride * ctypes.sizeof(ctypes.c_float),
-                ctypes.c_void_p(
-                    offsetof(i, alignment) * ctypes.sizeof(ctypes.c_float))
+        self._ibo = None
+        self._instance_alignment = instance_alignment
+        self._instance_stride = 0
+        self.instance_count = 0
+        if instance_alignment:
+            self._instance_stride = sum(instance_alignment)
+            self._ibo = Buffer(GL_ARRAY_BUFFER, usage=instance_usage)
+            glBindBuffer(GL_ARRAY_BUFFER, self._ibo.id)
+            if instances is not None:
+                self._ibo.write(instances)
+                self.instance_count = \
+                    instances.size // self._instance_stride
+            _set_attributes(
+                instance_alignment,
+                self._attribute_count,
+                divisor=1
             )
-            glEnableVertexAttribArray(i)  # Unordered layout would not work!
 
-        glBindVertexArray(0)
+        gl_state().bind_vertex_array(0)
         glBindBuffer(GL_ARRAY_BUFFER, 0)
         glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
         debug('vo {} is created ({}, {}, {})'.
-              format(self, self._vbo, self._ebo, self._vao))
+              format(self, self._vbo.id,
+                     self._ebo.id if self._ebo else None, self._vao))
 
     def __del__(self):
-        if self._vbo is not None:
-            glDeleteBuffers(1, np.array([self._vbo]))
-        if self._ebo is not None:
-            glDeleteBuffers(1, np.array([self._ebo]))
+        self._vbo = None
+        self._ebo = None
+        self._ibo = None
         if self._vao is not None:
+            gl_state().forget_vertex_array(self._vao)
             glDeleteVertexArrays(1, np.array([self._vao]))
         debug('vo {} is deleted'.format(self))
 
     def __enter__(self):
-        glBindVertexArray(self._vao)
+        self.bind()
         return self
 
+    @property
+    def id(self):
+        return self._vao
+
+    def bind(self):
+        gl_state().bind_vertex_array(self._vao)
+
     def __exit__(self, exc_type, exc_value, tb):
-        glBindVertexArray(0)
+        gl_state().release_vertex_array()
+
+    # offset is None: vertices replace the whole buffer
+    # offset in vertices: vertices overwrite/extend from that vertex on
+    def update(self, vertices, offset=None):
+        if vertices.size % self._stride != 0:
+            raise ValueError
+
+        byte_offset = None
+        if offset is not None:
+            byte_offset = offset * self._stride * vertices.itemsize
+
+        glBindBuffer(GL_ARRAY_BUFFER, self._vbo.id)
+        self._vbo.write(vertices, byte_offset)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+        self._size = self._vbo.size // vertices.itemsize
+        self.v_count = int(self._size / self._stride)
+        if self._ebo is None:
+            self.count = self.v_count
+
+    # Same semantics as update(), offset counted in indices
+    def update_indices(self, indices, offset=None):
+        byte_offset = None
+        if offset is not None:
+            byte_offset = offset * indices.itemsize
+
+        # Element buffer binding is part of the VAO state
+        gl_state().bind_vertex_array(self._vao)
+        if self._ebo is None:
+            self._ebo = Buffer(GL_ELEMENT_ARRAY_BUFFER, usage=self._usage)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self._ebo.id)
+        self._ebo.write(indices, byte_offset)
+        gl_state().bind_vertex_array(0)
 
-    def update(self, vertices):
-        if vertices.size != self._size:
+        self.index_type = _index_types[indices.dtype]
+        self.count = self._ebo.size // indices.itemsize
+
+    # Same semantics as update(), offset counted in instances
+    def update_instances(self, instances, offset=None):
+        if self._ibo is None:
+            raise ValueError('vertex object has no instance attributes')
+        if instances.size % self._instance_stride != 0:
+            raise ValueError
+
+        byte_offset = None
+        if offset is not None:
+            byte_offset = offset * self._instance_stride * instances.itemsize
+
+        glBindBuffer(GL_ARRAY_BUFFER, self._ibo.id)
+        self._ibo.write(instances, byte_offset)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+        self.instance_count = \
+            self._ibo.size // (self._instance_stride * instances.itemsize)
+
+    # Source the per-vertex attributes from a StreamBuffer region written
+    # this frame instead of the vertex object's own buffer. offset is the
+    # byte offset returned by StreamBuffer.allocate; call again for every
+    # new region. update() does not affect drawing afterwards.
+    def stream_vertices(self, stream, offset, count):
+        self._point_attributes(stream, offset, self._alignment, 0, 0)
+
+        self.v_count = count
+        if self._ebo is None:
+            self.count = count
+
+    # Same for the per-instance attributes
+    def stream_instances(self, stream, offset, count):
+        if not self._instance_alignment:
+            raise ValueError('vertex object has no instance attributes')
+
+        self._point_attributes(
+            stream, offset, self._instance_alignment,
+            self._attribute_count, 1)
+        self.instance_count = count
+
+    def _point_attributes(self, stream, offset, alignment, first, divisor):
+        gl_state().bind_vertex_array(self._vao)
+        glBindBuffer(GL_ARRAY_BUFFER, stream.id)
+        _set_attributes(alignment, first, divisor=divisor, offset=offset)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        gl_state().bind_vertex_array(0)
+
+    # Draw helpers, the vertex object must be bound
+    def draw(self, mode=GL_TRIANGLES):
+        if self._ebo is not None:
+            glDrawElements(mode, self.count, self.index_type, None)
+        else:
+            glDrawArrays(mode, 0, self.count)
+
+    def draw_instanced(self, mode=GL_TRIANGLES, instance_count=None):
+        if instance_count is None:
+            instance_count = self.instance_count
+        if instance_count <= 0:
             return
 
-        glBindBuffer(GL_ARRAY_BUFFER, self._vbo)
-        glBufferData(
-            GL_ARRAY_BUFFER,
-            vertices,
-            GL_STATIC_DRAW
+        if self._ebo is not None:
+            glDrawElementsInstanced(
+                mode,
+                self.count,
+                self.index_type,
+                None,
+                instance_count
+            )
+        else:
+            glDrawArraysInstanced(mode, 0, self.count, instance_count)
+
+
+# Float attributes interleaved in the bound GL_ARRAY_BUFFER
+def _set_attributes(alignment, first_location, divisor=0, offset=0):
+    stride = sum(alignment)
+    for i in range(len(alignment)):
+        location = first_location + i
+        glVertexAttribPointer(
+            location,
+            alignment[i],
+            GL_FLOAT,
+            False,
+            stride * ctypes.sizeof(ctypes.c_float),
+            ctypes.c_void_p(
+                offset +
+                offsetof(i, alignment) * ctypes.sizeof(ctypes.c_float))
         )
-        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        glEnableVertexAttribArray(location)  # Unordered layout would not work!
+        if divisor:
+            glVertexAttribDivisor(location, divisor)
+
+
+def wait_fence(fence, timeout_ns=1000000000):
+    status = glClientWaitSync(fence, GL_SYNC_FLUSH_COMMANDS_BIT, 0)
+    while status == GL_TIMEOUT_EXPIRED:
+        status = glClientWaitSync(
+            fence, GL_SYNC_FLUSH_COMMANDS_BIT, timeout_ns)
+
+
+# Wrap mapped buffer memory as a uint8 numpy array without copying
+def mapped_array(pointer, nbytes):
+    if isinstance(pointer, ctypes.c_void_p):
+        pointer = pointer.value
+    data = (ctypes.c_ubyte * nbytes).from_address(pointer)
+    return np.ctypeslib.as_array(data)
+
+
+class StreamBuffer:
+
+    # capacity in bytes, split evenly between `segments` frames in flight
+    def __init__(self, capacity=4 * 1024 * 1024, target=GL_ARRAY_BUFFER,
+                 segments=3):
+        self.target = target
+        self.segment_size = capacity // segments
+        self.capacity = self.segment_size * segments
+
+        self._fences = [None] * segments
+        self._segment = -1
+        self._head = 0
+        self._base = 0
+        self._data = None
+
+        # Persistent coherent mapping when ARB_buffer_storage exists,
+        # otherwise unsynchronized per-frame mapping guarded by fences
+        self._persistent = bool(glBufferStorage)
+
+        self._id = glGenBuffers(1)
+        glBindBuffer(self.target, self._id)
+        if self._persistent:
+            flags = GL_MAP_WRITE_BIT | GL_MAP_PERSISTENT_BIT | \
+                GL_MAP_COHERENT_BIT
+            glBufferStorage(self.target, self.capacity, None, flags)
+            pointer = glMapBufferRange(self.target, 0, self.capacity, flags)
+            self._data = mapped_array(pointer, self.capacity)
+        else:
+            glBufferData(self.target, self.capacity, None, GL_STREAM_DRAW)
+        glBindBuffer(self.target, 0)
+
+    def __del__(self):
+        for fence in self._fences:
+            if fence is not None:
+                glDeleteSync(fence)
+        if self._data is not None:
+            self._data = None
+            glBindBuffer(self.target, self._id)
+            glUnmapBuffer(self.target)
+            glBindBuffer(self.target, 0)
+        glDeleteBuffers(1, np.array([self._id]))
+
+    def __enter__(self):
+        glBindBuffer(self.target, self._id)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        glBindBuffer(self.target, 0)
+
+    @property
+    def id(self):
+        return self._id
+
+    # Start a frame: move to the next segment once the GPU is done with it
+    def begin(self):
+        self._segment = (self._segment + 1) % len(self._fences)
+        self._head = 0
+
+        fence = self._fences[self._segment]
+        if fence is not None:
+            wait_fence(fence)
+            glDeleteSync(fence)
+            self._fences[self._segment] = None
+
+        start = self._segment * self.segment_size
+        if self._persistent:
+            self._base = 0
+        else:
+            glBindBuffer(self.target, self._id)
+            pointer = glMapBufferRange(
+                self.target,
+                start,
+                self.segment_size,
+                GL_MAP_WRITE_BIT | GL_MAP_UNSYNCHRONIZED_BIT |
+                GL_MAP_INVALIDATE_RANGE_BIT
+            )
+            glBindBuffer(self.target, 0)
+            self._data = mapped_array(pointer, self.segment_size)
+            self._base = start
+
+    # Returns (numpy view to fill, byte offset in the buffer). The offset
+    # is a multiple of one row (shape[1:]), so offset // row size can be
+    # passed as `first` to glDrawArrays.
+    def allocate(self, shape, dtype='float32'):
+        if self._segment < 0 or self._data is None:
+            raise RuntimeError(
+                'allocate() must be called between begin() and commit()')
+
+        shape = tuple(np.atleast_1d(shape))
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        row = max(nbytes // shape[0], dtype.itemsize) if shape[0] else 1
+
+        start = self._segment * self.segment_size
+        offset = start + self._head
+        offset = (offset + row - 1) // row * row
+        if offset + nbytes > start + self.segment_size:
+            raise ValueError('stream buffer segment is full')
+
+        self._head = offset + nbytes - start
+        local = offset - self._base
+        view = self._data[local:local + nbytes].view(dtype).reshape(shape)
+        return view, offset
+
+    # Make the written data visible before issuing draws
+    def commit(self):
+        if not self._persistent and self._data is not None:
+            self._data = None
+            glBindBuffer(self.target, self._id)
+            glUnmapBuffer(self.target)
+            glBindBuffer(self.target, 0)
+
+    # End a frame: call after the draws reading this frame's data
+    def end(self):
+        self.commit()
+        self._fences[self._segment] = glFenceSync(
+            GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+
+
+class PixelBufferRing:
+
+    # target: GL_PIXEL_UNPACK_BUFFER (upload) or GL_PIXEL_PACK_BUFFER
+    def __init__(self, target, count=3, usage=None):
+        if usage is None:
+            usage = GL_STREAM_DRAW \
+                if target == GL_PIXEL_UNPACK_BUFFER else GL_STREAM_READ
+
+        self.target = target
+        self.usage = usage
+        self._buffers = [glGenBuffers(1) for _ in range(count)]
+        self._capacities = [0] * count
+        self._fences = [None] * count
+        self._index = 0
+
+    def __del__(self):
+        for i in range(len(self._buffers)):
+            self._delete_fence(i)
+        glDeleteBuffers(len(self._buffers), np.array(self._buffers))
+
+    def __len__(self):
+        return len(self._buffers)
+
+    def _delete_fence(self, index):
+        if self._fences[index] is not None:
+            glDeleteSync(self._fences[index])
+            self._fences[index] = None
+
+    def is_ready(self, index):
+        fence = self._fences[index]
+        if fence is None:
+            return True
+        status = glClientWaitSync(fence, 0, 0)
+        return status in (GL_ALREADY_SIGNALED, GL_CONDITION_SATISFIED)
+
+    # Blocks until the GPU no longer uses the buffer at index
+    def wait(self, index):
+        if self._fences[index] is None:
+            return
+
+        wait_fence(self._fences[index])
+        self._delete_fence(index)
+
+    # Returns index of the next buffer, bound and large enough for nbytes
+    def acquire(self, nbytes):
+        index = self._index
+        self._index = (self._index + 1) % len(self._buffers)
+
+        self.wait(index)
+        glBindBuffer(self.target, self._buffers[index])
+        if self._capacities[index] < nbytes:
+            glBufferData(self.target, nbytes, None, self.usage)
+            self._capacities[index] = nbytes
+
+        return index
+
+    # Call after the GL command reading/writing the buffer is issued
+    def fence(self, index):
+        self._delete_fence(index)
+        self._fences[index] = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+
+    def write(self, array):
+        pointer = glMapBufferRange(
+            self.target,
+            0,
+            array.nbytes,
+            GL_MAP_WRITE_BIT | GL_MAP_INVALIDATE_BUFFER_BIT
+        )
+        ctypes.memmove(pointer, array.ctypes.data, array.nbytes)
+        glUnmapBuffer(self.target)
+
+    def read(self, out):
+        pointer = glMapBufferRange(self.target, 0, out.nbytes, GL_MAP_READ_BIT)
+        ctypes.memmove(out.ctypes.data, pointer, out.nbytes)
+        glUnmapBuffer(self.target)
+        return out
+
+    def bind(self, index):
+        glBindBuffer(self.target, self._buffers[index])
+
+    def release(self):
+        glBindBuffer(self.target, 0)
+
+
+class AsyncReadback:
+
+    _formats = {
+        'rgb': (GL_RGB, 3),
+        'rgba': (GL_RGBA, 4),
+    }
+
+    # count: readbacks that may be in flight before read() has to wait
+    def __init__(self, count=3):
+        self._ring = PixelBufferRing(GL_PIXEL_PACK_BUFFER, count=count)
+        self._pending = collections.deque()
+
+    def __len__(self):
+        return len(self._pending)
+
+    # Queue a read of the bound framebuffer, returns a Future resolved by
+    # poll() with a (height, width, channels) uint8 array, bottom-up rows
+    def read(self, x, y, width, height, mode='rgb'):
+        format_, channels = self._formats[mode.lower()]
+        shape = (height, width, channels)
+
+        # Every buffer is in flight: the oldest one has to land first
+        if len(self._pending) >= len(self._ring):
+            self._resolve(*self._pending.popleft())
+
+        index = self._ring.acquire(height * width * channels)
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        glReadPixels(
+            x, y,
+            width, height,
+            format_,
+            GL_UNSIGNED_BYTE,
+            ctypes.c_void_p(0)
+        )
+        glPixelStorei(GL_PACK_ALIGNMENT, 4)
+        self._ring.fence(index)
+        self._ring.release()
+
+        future = Future()
+        self._pending.append((index, future, shape))
+        return future
+
+    # Resolve finished readbacks, without stalling unless block is True
+    def poll(self, block=False):
+        while self._pending:
+            index, future, shape = self._pending[0]
+            if not block and not self._ring.is_ready(index):
+                break
+            self._pending.popleft()
+            self._resolve(index, future, shape)
+
+    def _resolve(self, index, future, shape):
+        self._ring.wait(index)
+        self._ring.bind(index)
+        # The only copy: out of the mapped buffer so it can be reused
+        data = self._ring.read(np.empty(shape, dtype='uint8'))
+        self._ring.release()
+        future.set_result(data)
+
+
+# (channel order, channels) -> (internal format, external format, swizzle)
+_texture_formats = {
+    ('rgb', 1): (GL_R8, GL_RED, (GL_RED, GL_RED, GL_RED, GL_ONE)),
+    ('rgb', 2): (GL_RG8, GL_RG, None),
+    ('rgb', 3): (GL_RGB8, GL_RGB, None),
+    ('rgb', 4): (GL_RGBA8, GL_RGBA, None),
+    ('bgr', 1): (GL_R8, GL_RED, (GL_RED, GL_RED, GL_RED, GL_ONE)),
+    ('bgr', 2): (GL_RG8, GL_RG, None),
+    ('bgr', 3): (GL_RGB8, GL_BGR, None),
+    ('bgr', 4): (GL_RGBA8, GL_BGRA, None),
+}
 
 
 class Texture:
 
     def __init__(self, **kwargs):
         self._tex_id = glGenTextures(1)
+        self._target = GL_TEXTURE_2D
+        self._unit = GL_TEXTURE0
+        self.unit_number = 0
+        self.channel_order = 'rgb'
+
+        # (width, height, internal format) of the allocated storage
+        self._storage = None
+        self._immutable = bool(glTexStorage2D)
+        self._sampler_ready = False
+
+        # Multi-buffered asynchronous upload when pbo_count > 1
+        pbo_count = kwargs.pop('pbo_count', 0)
+        self._pbo_ring = None
+        if pbo_count > 1 and bool(glFenceSync):
+            self._pbo_ring = PixelBufferRing(
+                GL_PIXEL_UNPACK_BUFFER, count=pbo_count)
+
         self.update(**kwargs)
 
     def __del__(self):
+        self._pbo_ring = None
+        gl_state().forget_texture(self._tex_id)
         glDeleteTextures(np.array([self._tex_id], dtype='int32'))
 
     def __enter__(self):
-        glActiveTexture(self._unit)
-        glBindTexture(self._target, self._tex_id)
+        self.bind()
         return self
 
+    @property
+    def id(self):
+        return self._tex_id
+
+    def bind(self):
+        gl_state().bind_texture(self._unit, self._target, self._tex_id)
+
     def __exit__(self, exc_type, exc_value, tb):
-        glActiveTexture(self._unit)
-        glBindTexture(self._target, 0)
+        gl_state().release_texture(self._unit, self._target)
 
-    # image is numpy uint8 array
-    def update(self, **kwargs):
-        self._target = kwargs.pop('target', GL_TEXTURE_2D)
-        self._unit = kwargs.pop('unit', GL_TEXTURE0)
-        self.unit_number = self._unit - GL_TEXTURE0
+    @property
+    def width(self):
+        return self._storage[0] if self._storage else 0
 
-        image = kwargs.pop('image', None)
-        if image is not None:
-            glBindTexture(self._target, self._tex_id)
-            glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
-            glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
-            glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
-            glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+    @property
+    def height(self):
+        return self._storage[1] if self._storage else 0
+
+    def _set_sampler(self):
+        glTexParameteri(self._target, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+        glTexParameteri(self._target, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+        glTexParameteri(self._target, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        glTexParameteri(self._target, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+        self._sampler_ready = True
+
+    # Texture must be bound
+    def _allocate(self, width, height, internal_format, swizzle=None):
+        storage = (width, height, internal_format)
+        if self._storage == storage:
+            return
+
+        if self._storage is not None and self._immutable:
+            # Immutable storage cannot be respecified, so start over
+            gl_state().forget_texture(self._tex_id)
+            glDeleteTextures(np.array([self._tex_id], dtype='int32'))
+            self._tex_id = glGenTextures(1)
+            gl_state().bind_texture(self._unit, self._target, self._tex_id)
+            self._sampler_ready = False
+
+        if not self._sampler_ready:
+            self._set_sampler()
+
+        if swizzle is None:
+            swizzle = (GL_RED, GL_GREEN, GL_BLUE, GL_ALPHA)
+        glTexParameteriv(
+            self._target,
+            GL_TEXTURE_SWIZZLE_RGBA,
+            np.array(swizzle, dtype='int32')
+        )
+
+        if self._immutable:
+            glTexStorage2D(self._target, 1, internal_format, width, height)
+        else:
             glTexImage2D(
                 self._target,
                 0,
-                GL_RGB,
-                image.shape[1], image.shape[0],
+                internal_format,
+                width, height,
                 0,
-                GL_RGB,  # BGR
+                GL_RED,
                 GL_UNSIGNED_BYTE,
-                image
+                None
             )
-            glBindTexture(self._target, 0)
+
+        self._storage = storage
+        debug('texture {} is allocated ({}x{})'.
+              format(self._tex_id, width, height))
+
+    # Storage without contents, e.g. as a render target
+    def allocate(self, width, height, internal_format=GL_RGBA8):
+        state = gl_state()
+        state.bind_texture(self._unit, self._target, self._tex_id)
+        self._allocate(width, height, internal_format)
+        state.release_texture(self._unit, self._target)
+
+    # image is numpy uint8 array of shape (h, w) or (h, w, channels)
+    # channel_order: 'rgb' or 'bgr' (as delivered by OpenCV)
+    def update(self, **kwargs):
+        self._target = kwargs.pop('target', self._target)
+        self._unit = kwargs.pop('unit', self._unit)
+        self.unit_number = self._unit - GL_TEXTURE0
+        self.channel_order = kwargs.pop('channel_order', self.channel_order)
+
+        image = kwargs.pop('image', None)
+        if image is not None:
+            height, width = image.shape[0], image.shape[1]
+            channels = image.shape[2] if image.ndim > 2 else 1
+            internal_format, external_format, swizzle = \
+                _texture_formats[(self.channel_order, channels)]
+
+            # Negative strides would make PyOpenGL copy anyway
+            image = np.ascontiguousarray(image)
+
+            state = gl_state()
+            state.bind_texture(self._unit, self._target, self._tex_id)
+            self._allocate(width, height, internal_format, swizzle)
+            glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+            if self._pbo_ring:
+                self._upload_async(image, width, height, external_format)
+            else:
+                glTexSubImage2D(
+                    self._target,
+                    0,
+                    0, 0,
+                    width, height,
+                    external_format,
+                    GL_UNSIGNED_BYTE,
+                    image
+                )
+            glPixelStorei(GL_UNPACK_ALIGNMENT, 4)
+            state.release_texture(self._unit, self._target)
+
+    # Copy into a PBO and let the driver transfer it while we move on.
+    # The fence keeps the PBO from being rewritten while still in flight.
+    def _upload_async(self, image, width, height, external_format):
+        ring = self._pbo_ring
+        index = ring.acquire(image.nbytes)
+        ring.write(image)
+        glTexSubImage2D(
+            self._target,
+            0,
+            0, 0,
+            width, height,
+            external_format,
+            GL_UNSIGNED_BYTE,
+            ctypes.c_void_p(0)
+        )
+        ring.fence(index)
+        ring.release()
+
+
+class Framebuffer:
+
+    def __init__(self):
+        self._id = glGenFramebuffers(1)
+
+    def __del__(self):
+        gl_state().forget_framebuffer(self._id)
+        glDeleteFramebuffers(1, np.array([self._id]))
+
+    @property
+    def id(self):
+        return self._id
+
+    def bind(self):
+        gl_state().bind_framebuffer(self._id)
+
+    # Framebuffer must be bound
+    def attach_texture(self, attachment, texture):
+        glFramebufferTexture2D(
+            GL_FRAMEBUFFER,
+            attachment,
+            GL_TEXTURE_2D,
+            texture.id,
+            0
+        )
+
+    def attach_renderbuffer(self, attachment, renderbuffer):
+        glFramebufferRenderbuffer(
+            GL_FRAMEBUFFER,
+            attachment,
+            GL_RENDERBUFFER,
+            renderbuffer
+        )
+
+    def check(self):
+        status = glCheckFramebufferStatus(GL_FRAMEBUFFER)
+        if status != GL_FRAMEBUFFER_COMPLETE:
+            raise RuntimeError(
+                'framebuffer {} is incomplete: {}'.format(self._id, status))
+
+
+class RenderTarget:
+
+    # color_formats: internal format of each color attachment
+    # depth: attach a depth renderbuffer
+    def __init__(self, width, height, color_formats=(GL_RGBA8,),
+                 depth=False, unit=GL_TEXTURE0):
+        self.framebuffer = Framebuffer()
+        self.textures = [Texture(unit=unit) for _ in color_formats]
+        self.color_formats = tuple(color_formats)
+        self.width = 0
+        self.height = 0
+
+        self._depth = glGenRenderbuffers(1) if depth else None
+        self._saved = []
+
+        self.resize(width, height)
+
+    def __del__(self):
+        if self._depth is not None:
+            glDeleteRenderbuffers(1, np.array([self._depth]))
+
+    @property
+    def texture(self):
+        return self.textures[0]
+
+    def resize(self, width, height):
+        width, height = max(int(width), 1), max(int(height), 1)
+        if (width, height) == (self.width, self.height):
+            return
+
+        for texture, internal_format in zip(self.textures,
+                                            self.color_formats):
+            texture.allocate(width, height, internal_format)
+
+        state = gl_state()
+        previous = state.framebuffer
+        self.framebuffer.bind()
+        # Immutable textures get new names when resized, so reattach
+        for i, texture in enumerate(self.textures):
+            self.framebuffer.attach_texture(GL_COLOR_ATTACHMENT0 + i, texture)
+        if self._depth is not None:
+            glBindRenderbuffer(GL_RENDERBUFFER, self._depth)
+            glRenderbufferStorage(
+                GL_RENDERBUFFER, GL_DEPTH_COMPONENT24, width, height)
+            glBindRenderbuffer(GL_RENDERBUFFER, 0)
+            self.framebuffer.attach_renderbuffer(
+                GL_DEPTH_ATTACHMENT, self._depth)
+        glDrawBuffers(
+            len(self.textures),
+            np.array([GL_COLOR_ATTACHMENT0 + i
+                      for i in range(len(self.textures))], dtype='uint32')
+        )
+        self.framebuffer.check()
+        state.bind_framebuffer(
+            previous if previous is not None else state.default_framebuffer)
+
+        self.width = width
+        self.height = height
+        debug('render target {} is resized ({}x{})'.
+              format(self.framebuffer.id, width, height))
+
+    # Binds the target with a matching viewport, restoring both on exit
+    def __enter__(self):
+        state = gl_state()
+        framebuffer = state.framebuffer
+        if framebuffer is None:
+            framebuffer = state.default_framebuffer
+        self._saved.append((framebuffer, state.get_viewport()))
+
+        self.framebuffer.bind()
+        state.set_viewport(0, 0, self.width, self.height)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        framebuffer, viewport = self._saved.pop()
+        state = gl_state()
+        state.bind_framebuffer(framebuffer)
+        state.set_viewport(*viewport)
+
+    # Target must be bound
+    def clear(self, color=(0.0, 0.0, 0.0, 0.0)):
+        glClearColor(*color)
+        mask = GL_COLOR_BUFFER_BIT
+        if self._depth is not None:
+            mask |= GL_DEPTH_BUFFER_BIT
+        glClear(mask)
+
+
+class YUVTexture:
+
+    layouts = ('nv12', 'i420', 'yuyv')
+
+    # FOURCC codes reported by capture devices
+    fourcc_layouts = {
+        'NV12': 'nv12',
+        'I420': 'i420',
+        'IYUV': 'i420',
+        'YU12': 'i420',
+        'YUYV': 'yuyv',
+        'YUY2': 'yuyv',
+    }
+
+    # Planes are bound to consecutive units starting at unit
+    def __init__(self, layout='nv12', unit=GL_TEXTURE0):
+        if layout not in self.layouts:
+            raise ValueError('unknown yuv layout: {}'.format(layout))
+
+        self.layout = layout
+        plane_count = 3 if layout == 'i420' else 2
+        self.planes = [Texture(unit=unit + i) for i in range(plane_count)]
+
+    def __enter__(self):
+        self.bind()
+        return self
+
+    def bind(self):
+        for plane in self.planes:
+            plane.bind()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        for plane in reversed(self.planes):
+            plane.__exit__(exc_type, exc_value, tb)
+
+    @property
+    def layout_index(self):
+        return self.layouts.index(self.layout)
+
+    @property
+    def unit_numbers(self):
+        return [plane.unit_number for plane in self.planes]
+
+    # image: raw frame buffer as delivered with CAP_PROP_CONVERT_RGB=0
+    def update(self, image, width, height):
+        data = np.ravel(image)
+        w, h = int(width), int(height)
+        luma = w * h
+
+        if self.layout == 'nv12':
+            # Y plane followed by interleaved half-resolution UV
+            planes = [
+                data[:luma].reshape(h, w),
+                data[luma:luma * 3 // 2].reshape(h // 2, w // 2, 2),
+            ]
+        elif self.layout == 'i420':
+            # Y, U and V planes, chroma at half resolution
+            chroma = luma // 4
+            planes = [
+                data[:luma].reshape(h, w),
+                data[luma:luma + chroma].reshape(h // 2, w // 2),
+                data[luma + chroma:luma + chroma * 2].
+                reshape(h // 2, w // 2),
+            ]
+        else:
+            # Y0 U Y1 V: as RG the red channel is luma, as RGBA green
+            # and alpha hold the chroma shared by each pixel pair
+            packed = data[:luma * 2]
+            planes = [
+                packed.reshape(h, w, 2),
+                packed.reshape(h, w // 2, 4),
+            ]
+
+        for texture, plane in zip(self.planes, planes):
+            texture.update(image=plane, channel_order='rgb')
+
+
+class DrawItem:
+
+    __slots__ = ('key', 'draw', 'program', 'vertex_object', 'textures',
+                 'name')
+
+    def __init__(self, key, draw, program, vertex_object, textures, name):
+        self.key = key
+        self.draw = draw
+        self.program = program
+        self.vertex_object = vertex_object
+        self.textures = textures
+        self.name = name
+
+
+class RenderQueue:
+
+    def __init__(self):
+        self._items = []
+        self._segment = 0
+        self.stats = {}
+
+    def __len__(self):
+        return len(self._items)
+
+    # draw: callable(program) issuing the draw with the given state bound
+    # textures: Texture objects (or YUVTexture, expanded to its planes)
+    def submit(self, draw, program=None, vertex_object=None, textures=(),
+               layer=0, name=''):
+        planes = []
+        for texture in textures:
+            planes.extend(getattr(texture, 'planes', [texture]))
+
+        # Opaque items are barriers: nothing is moved across them, so they
+        # stay in painter's order with the items around them
+        opaque = program is None
+        if opaque:
+            self._segment += 1
+        key = (
+            layer,
+            self._segment,
+            program.id if program is not None else 0,
+            tuple([t.id for t in planes]),
+            vertex_object.id if vertex_object is not None else 0,
+        )
+        if opaque:
+            self._segment += 1
+        self._items.append(
+            DrawItem(key, draw, program, vertex_object, planes, name))
+
+    # Sort by (layer, segment, program, textures, VAO) and execute. The
+    # sort is stable, so items with the same key keep their submission
+    # order.
+    def flush(self):
+        items = self._items
+        self._items = []
+        self._segment = 0
+        items.sort(key=lambda item: item.key)
+
+        state = gl_state()
+        issued, elided = state.issued, state.elided
+        stats = {
+            'draw_calls': 0,
+            'program_changes': 0,
+            'texture_changes': 0,
+            'vertex_array_changes': 0,
+        }
+
+        program = vertex_array = textures = None
+        for item in items:
+            key = item.key
+            if item.program is not None and key[2] != program:
+                item.program.bind()
+                program = key[2]
+                stats['program_changes'] += 1
+            if key[3] and key[3] != textures:
+                for texture in item.textures:
+                    texture.bind()
+                textures = key[3]
+                stats['texture_changes'] += 1
+            if item.vertex_object is not None and key[4] != vertex_array:
+                item.vertex_object.bind()
+                vertex_array = key[4]
+                stats['vertex_array_changes'] += 1
+
+            with profile_section(item.name):
+                item.draw(item.program)
+            stats['draw_calls'] += 1
+
+            if item.program is None:
+                # Opaque item: it may have bound anything
+                program = vertex_array = textures = None
+
+        stats['binds_issued'] = state.issued - issued
+        stats['binds_elided'] = state.elided - elided
+        self.stats = stats
+        return stats
+
+
+class GPUProfiler:
+
+    # history: samples kept per section for the rolling statistics
+    def __init__(self, history=120):
+        self.history = history
+        self.frame = 0
+
+        self._pool = []
+        self._open = []
+        self._pending = collections.deque()
+        self._samples = {}
+
+    def __del__(self):
+        queries = self._pool + [q for _, q in self._open]
+        for _, begin, end in self._pending:
+            queries.extend([begin, end])
+        if queries:
+            glDeleteQueries(len(queries), np.array(queries, dtype='uint32'))
+
+    def _timestamp(self):
+        if self._pool:
+            query = self._pool.pop()
+        else:
+            query = int(np.ravel(glGenQueries(1))[0])
+        glQueryCounter(query, GL_TIMESTAMP)
+        return query
+
+    # Timestamp pairs rather than GL_TIME_ELAPSED so sections may nest
+    def begin(self, name):
+        self._open.append((name, self._timestamp()))
+
+    def end(self):
+        name, begin = self._open.pop()
+        self._pending.append((name, begin, self._timestamp()))
+
+    def section(self, name):
+        return _ProfilerSection(self, name)
+
+    # Read back finished queries; never waits for the GPU
+    def collect(self):
+        while self._pending:
+            name, begin, end = self._pending[0]
+            if not glGetQueryObjectiv(end, GL_QUERY_RESULT_AVAILABLE):
+                # Results arrive in submission order
+                break
+            self._pending.popleft()
+
+            t0 = _query_result64(begin)
+            t1 = _query_result64(end)
+            self._pool.extend([begin, end])
+
+            samples = self._samples.get(name)
+            if samples is None:
+                samples = collections.deque(maxlen=self.history)
+                self._samples[name] = samples
+            samples.append((int(t1) - int(t0)) / 1e6)
+
+    def end_frame(self):
+        self.frame += 1
+        self.collect()
+
+    def reset(self):
+        self._samples = {}
+
+    # Milliseconds of GPU time per section
+    def stats(self):
+        stats = {}
+        for name, samples in self._samples.items():
+            if not samples:
+                continue
+            data = np.array(samples)
+            stats[name] = {
+                'count': len(data),
+                'last': float(data[-1]),
+                'mean': float(data.mean()),
+                'min': float(data.min()),
+                'max': float(data.max()),
+                'p50': float(np.percentile(data, 50)),
+                'p95': float(np.percentile(data, 95)),
+            }
+        return stats
+
+    def to_json(self):
+        return json.dumps(
+            {'frame': self.frame, 'sections': self.stats()}, indent=2)
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            f.write(self.to_json())
+
+
+# The wrapped glGetQueryObjectui64v has no output size for 64-bit results
+# and raises KeyError, so go through the raw entry point
+def _query_result64(query):
+    value = ctypes.c_uint64(0)
+    _glGetQueryObjectui64v(query, GL_QUERY_RESULT, ctypes.byref(value))
+    return value.value
+
+
+class _ProfilerSection:
+
+    def __init__(self, profiler, name):
+        self._profiler = profiler
+        self._name = name
+
+    def __enter__(self):
+        if self._profiler:
+            self._profiler.begin(self._name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self._profiler:
+            self._profiler.end()
+
+
+_profiler = None
+_null_section = _ProfilerSection(None, '')
+
+
+# Profiler used by renderers, None disables profiling
+def set_profiler(profiler):
+    global _profiler
+    _profiler = profiler
+
+
+def profile_section(name):
+    if _profiler is None:
+        return _null_section
+    return _profiler.section(name)
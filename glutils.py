@@ -1,6 +1,8 @@
 import ctypes
+import numpy as np
 
 from OpenGL.GL import *
+from OpenGL.error import GLError
 from OpenGL.GLU import gluErrorString
 from PIL import Image
 
@@ -11,12 +13,19 @@ def check_glerror(message='check_glerror'):
     print('{}: {}'.format(message, gluErrorString(err)))
 
 
-def create_program(shaders):
+def create_program(shaders, retrievable=False):
     program = glCreateProgram()
 
     for shader in shaders:
         glAttachShader(program, shader)
 
+    if retrievable:
+        glProgramParameteri(
+            program,
+            GL_PROGRAM_BINARY_RETRIEVABLE_HINT,
+            GL_TRUE
+        )
+
     glLinkProgram(program)
 
     status = glGetProgramiv(program, GL_LINK_STATUS)
@@ -58,6 +67,53 @@ def create_shader(shader_type, shader_code):
     return shader
 
 
+def driver_signature():
+    strings = [glGetString(name) for name in
+               (GL_VENDOR, GL_RENDERER, GL_VERSION)]
+    return '|'.join(
+        [s.decode() if isinstance(s, bytes) else str(s) for s in strings])
+
+
+def supports_program_binary():
+    if not bool(glGetProgramBinary) or not bool(glProgramBinary):
+        return False
+    return glGetIntegerv(GL_NUM_PROGRAM_BINARY_FORMATS) > 0
+
+
+# Returns (binary_format, bytes) of a linked program
+def get_program_binary(program):
+    length = glGetProgramiv(program, GL_PROGRAM_BINARY_LENGTH)
+    if length <= 0:
+        return None, None
+
+    written = np.zeros(1, dtype='int32')
+    binary_format = np.zeros(1, dtype='uint32')
+    binary = np.zeros(length, dtype='uint8')
+    glGetProgramBinary(program, length, written, binary_format, binary)
+
+    return int(binary_format[0]), binary[:written[0]].tobytes()
+
+
+# Returns a linked program, or -1 when the driver rejects the binary.
+# Unknown formats raise GLError (GL_INVALID_ENUM) instead of failing
+# the link; the program is deleted before it propagates.
+def load_program_binary(binary_format, binary):
+    program = glCreateProgram()
+    data = np.frombuffer(binary, dtype='uint8')
+    try:
+        glProgramBinary(program, binary_format, data, data.size)
+    except GLError:
+        glDeleteProgram(program)
+        raise
+
+    status = glGetProgramiv(program, GL_LINK_STATUS)
+    if status == GL_FALSE:
+        glDeleteProgram(program)
+        return -1
+
+    return program
+
+
 def offsetof(index, alignment):
     offset = 0
     for i in range(0, index):
@@ -1,10 +1,14 @@
+import ctypes
 import cyglfw3 as glfw
 import numpy as np
 import os
+import threading
+import time
+import weakref
 
 from OpenGL.GL import *
-from PIL import Image
-from threading import Thread
+from threading import Event, Thread, Timer
+from tracing import span
 
 from renderer import *
 
@@ -17,6 +21,27 @@ class GLView:
         self._title = title
         self._renderer = None
         self._next_renderer = None
+        self._framebuffer_size = None
+        self._readback = None
+
+        # Called as listener(glview) after each frame is rendered, before
+        # it is presented; the place to capture frames
+        self.frame_listeners = []
+        self._recording_listener = None
+
+        # on_demand: draw only when a renderer is dirty, on input, resize
+        #   or request_redraw(), sleeping in between
+        # idle_timeout: longest sleep (seconds) while nothing happens
+        # target_fps: upper bound of the frame rate (None: unbounded)
+        self.on_demand = False
+        self.idle_timeout = 0.5
+        self.target_fps = None
+        self._swap_interval = None
+        self._redraw = Event()
+        self._render_thread = None
+
+        # Optional framework.GPUProfiler timing each renderer
+        self.profiler = None
 
         self._initialize()
 
@@ -54,6 +79,12 @@ class GLView:
             self._height,
             self._title
         )
+        # glfw keeps callbacks in module globals: a closure over self
+        # would keep the view alive forever
+        glfw.SetWindowRefreshCallback(
+            self._win,
+            _weak_callback(self.request_redraw)
+        )
 
     @property
     def renderer(self):
@@ -62,6 +93,41 @@ class GLView:
     @renderer.setter
     def renderer(self, value):
         self._next_renderer = value
+        self.request_redraw()
+
+    # 0 disables vsync, 1 syncs every frame; applied in run_loop
+    @property
+    def swap_interval(self):
+        return self._swap_interval
+
+    @swap_interval.setter
+    def swap_interval(self, value):
+        self._swap_interval = value
+
+    # Thread-safe: wakes run_loop up in on-demand mode
+    def request_redraw(self):
+        self._redraw.set()
+        self._wake()
+
+    # Invalidate callback of the renderer. Changes made by the renderer
+    # itself while drawing are already in this frame and must not
+    # schedule another one.
+    def _renderer_invalidated(self):
+        if self._render_thread == threading.get_ident():
+            return
+        self.request_redraw()
+
+    # Input callbacks also schedule a redraw
+    def _redrawing(self, callback):
+        if callback is None:
+            return None
+
+        redraw = _weak_callback(self.request_redraw)
+
+        def _callback(*args):
+            redraw()
+            callback(*args)
+        return _callback
 
     @property
     def key_callback(self):
@@ -71,7 +137,10 @@ class GLView:
     def key_callback(self, value):
         self._key_callback = value
         if self._win:
-            glfw.SetKeyCallback(self._win, self._key_callback)
+            glfw.SetKeyCallback(
+                self._win,
+                self._redrawing(self._key_callback)
+            )
 
     @property
     def mbtn_callback(self):
@@ -81,7 +150,10 @@ class GLView:
     def mbtn_callback(self, value):
         self._mbtn_callback = value
         if self._win:
-            glfw.SetMouseButtonCallback(self._win, self._mbtn_callback)
+            glfw.SetMouseButtonCallback(
+                self._win,
+                self._redrawing(self._mbtn_callback)
+            )
 
     @property
     def mpos_callback(self):
@@ -91,7 +163,10 @@ class GLView:
     def mpos_callback(self, value):
         self._mpos_callback = value
         if self._win:
-            glfw.SetCursorPosCallback(self._win, self._mpos_callback)
+            glfw.SetCursorPosCallback(
+                self._win,
+                self._redrawing(self._mpos_callback)
+            )
 
     @property
     def close_callback(self):
@@ -115,60 +190,513 @@ class GLView:
             return glfw.GetWindowSize(self._win)[1]
         return 0.0
 
-    @property
+    # Returns (height, width, channels) uint8 array, bottom-up rows
     def snapshot(self, mode='RGB'):
         _modes = {
-            'rgb': GL_RGB,
-            'rgba': GL_RGBA,
+            'rgb': (GL_RGB, 3),
+            'rgba': (GL_RGBA, 4),
         }
 
-        if not self._win:
+        if not self._has_context():
             return None
 
+        self._make_current()
+        state = gl_state()
+        state.bind_framebuffer(state.default_framebuffer)
+        _, _, w, h = state.get_viewport()
+        format_, channels = _modes[mode.lower()]
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        data = glReadPixels(0, 0, w, h, format_, GL_UNSIGNED_BYTE)
+        glPixelStorei(GL_PACK_ALIGNMENT, 4)
+
+        return np.frombuffer(data, dtype='uint8').reshape(h, w, channels)
+
+    # Non-blocking snapshot through fenced pixel pack buffers. The future
+    # resolves a frame or two later inside run_loop. Call it from a frame
+    # listener so the frame about to be presented is captured.
+    def snapshot_async(self, mode='RGB'):
+        if self._readback is None:
+            self._readback = AsyncReadback()
+
+        state = gl_state()
+        state.bind_framebuffer(state.default_framebuffer)
+        _, _, w, h = state.get_viewport()
+        return self._readback.read(0, 0, w, h, mode)
+
+    # Feed every presented frame to a started cvutils.VideoRecorder
+    def start_recording(self, recorder):
+        def _capture(glview):
+            future = glview.snapshot_async()
+            future.add_done_callback(lambda f: recorder.put(f.result()))
+
+        self.stop_recording()
+        self._recording_listener = _capture
+        self.frame_listeners.append(_capture)
+
+    def stop_recording(self):
+        if self._recording_listener in self.frame_listeners:
+            self.frame_listeners.remove(self._recording_listener)
+        self._recording_listener = None
+
+    # Window system hooks, overridden by HeadlessGLView
+    def _has_context(self):
+        return bool(self._win)
+
+    def _make_current(self):
         glfw.MakeContextCurrent(self._win)
-        _, _, w, h = glGetIntegerv(GL_VIEWPORT)
-        data = glReadPixels(0, 0, w, h, _modes[mode.lower()], GL_UNSIGNED_BYTE)
-        data = Image.frombytes(mode=mode, size=(w, h), data=data)
+        make_state_current(id(self))
 
-        return np.asarray(data, dtype='uint8')
+    def _get_framebuffer_size(self):
+        return tuple(glfw.GetFramebufferSize(self._win))
 
-    def run_loop(self):
-        glfw.MakeContextCurrent(self._win)
+    def _set_should_close(self, value):
+        glfw.SetWindowShouldClose(self._win, value)
+
+    def _should_close(self):
+        return glfw.WindowShouldClose(self._win)
 
-        glfw.SetWindowShouldClose(self._win, False)
-        while not glfw.WindowShouldClose(self._win):
-            if self._next_renderer:
-                if self._renderer:
-                    self._renderer.dispose()
+    def _swap_buffers(self):
+        glfw.SwapBuffers(self._win)
 
-                self._renderer = self._next_renderer
-                self._renderer.prepare()
+    def _poll_events(self):
+        glfw.PollEvents()
 
-                self._next_renderer = None
+    # WaitEventsTimeout needs GLFW 3.2; older bindings wait until an
+    # empty event posted by a timer ends the wait
+    def _wait_events(self, timeout):
+        if hasattr(glfw, 'WaitEventsTimeout'):
+            glfw.WaitEventsTimeout(timeout)
+            return
 
-            glClearColor(0.5, 0.5, 0.5, 1.0)
-            glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        timer = Timer(timeout, glfw.PostEmptyEvent)
+        timer.start()
+        try:
+            glfw.WaitEvents()
+        finally:
+            timer.cancel()
+
+    def _wake(self):
+        if self._win:
+            glfw.PostEmptyEvent()
+
+    def _apply_swap_interval(self):
+        if self._swap_interval is not None:
+            glfw.SwapInterval(self._swap_interval)
+
+    def _draw_frame(self):
+        if self._next_renderer:
             if self._renderer:
-                self._renderer.render()
+                self._renderer.set_invalidate_callback(None)
+                self._renderer.dispose()
 
-            glfw.SwapBuffers(self._win)
+            self._renderer = self._next_renderer
+            self._renderer.set_invalidate_callback(
+                _weak_callback(self._renderer_invalidated))
+            self._renderer.prepare()
+            self._framebuffer_size = None
 
-            # Poll for and process events
-            glfw.PollEvents()
+            self._next_renderer = None
 
+        size = self._get_framebuffer_size()
+        if size != self._framebuffer_size:
+            self._framebuffer_size = size
+            if self._renderer:
+                self._renderer.reshape(*size)
+
+        state = gl_state()
+        state.bind_framebuffer(state.default_framebuffer)
+        glClearColor(0.5, 0.5, 0.5, 1.0)
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
         if self._renderer:
+            self._render_thread = threading.get_ident()
+            try:
+                with span('render'), profile_section(self._renderer.label):
+                    self._renderer.render()
+            finally:
+                self._render_thread = None
+            self._renderer.clear_dirty()
+
+        for listener in self.frame_listeners:
+            listener(self)
+
+    def _needs_redraw(self, on_demand):
+        if not on_demand or self._redraw.is_set():
+            return True
+        if self._next_renderer:
+            return True
+        if self._get_framebuffer_size() != self._framebuffer_size:
+            return True
+        return self._renderer is not None and self._renderer.needs_render()
+
+    # Sleep off the rest of the frame period when target_fps is set
+    def _pace(self, deadline):
+        if not self.target_fps:
+            return deadline
+
+        now = time.perf_counter()
+        deadline += 1.0 / self.target_fps
+        if deadline > now:
+            time.sleep(deadline - now)
+            return deadline
+        # Running late: do not try to catch up with a burst of frames
+        return now
+
+    # max_frames: stop after that many frames (None runs until closed)
+    # on_demand: overrides self.on_demand for this loop
+    def run_loop(self, max_frames=None, on_demand=None):
+        if on_demand is None:
+            on_demand = self.on_demand
+
+        self._make_current()
+        self._apply_swap_interval()
+        set_profiler(self.profiler)
+
+        frames = 0
+        deadline = time.perf_counter()
+        self._set_should_close(False)
+        while not self._should_close():
+            if max_frames is not None and frames >= max_frames:
+                break
+
+            if self._needs_redraw(on_demand):
+                self._redraw.clear()
+                with span('frame'):
+                    self._draw_frame()
+                    with span('swap'):
+                        self._swap_buffers()
+                frames += 1
+                deadline = self._pace(deadline)
+
+                if self.profiler:
+                    self.profiler.end_frame()
+
+            if self._readback:
+                self._readback.poll()
+
+            # Poll for and process events
+            if on_demand and not self._needs_redraw(on_demand):
+                timeout = self.idle_timeout
+                if self._readback:
+                    # Pending readbacks still have to be collected
+                    timeout = min(timeout, 0.005)
+                self._wait_events(timeout)
+            else:
+                self._poll_events()
+
+        if self._readback:
+            self._readback.poll(block=True)
+        set_profiler(None)
+
+        # Prepared again, with a fresh callback, by the next run_loop
+        if self._renderer:
+            self._renderer.set_invalidate_callback(None)
             self._renderer.dispose()
         if self._next_renderer is None:
             self._next_renderer = self._renderer
 
     def __del__(self):
-        glfw.MakeContextCurrent(self._win)
+        self._make_current()
         if self._renderer:
             self._renderer.dispose()
+        release_state(id(self))
         glfw.Terminate()
         debug('GLView is being deleted: {}'.format(self))
 
 
+class HeadlessGLView(GLView):
+
+    # backend: 'egl' (pbuffer) or 'osmesa' (e.g. llvmpipe). PyOpenGL binds
+    # its platform on first import, so PYOPENGL_PLATFORM must name the
+    # same backend before OpenGL is imported.
+    def __init__(self, width, height, title='', renderer=None, backend=None):
+        if backend is None:
+            backend = os.environ.get('PYOPENGL_PLATFORM', 'egl')
+        if backend not in ('egl', 'osmesa'):
+            raise ValueError('unknown headless backend: {}'.format(backend))
+        _check_platform(backend)
+
+        self._backend = backend
+        self._context = None
+        self._close_requested = False
+        super().__init__(width, height, title=title, renderer=renderer)
+
+    def _initialize(self):
+        self._win = None
+
+        if self._backend == 'egl':
+            self._initialize_egl()
+        else:
+            self._initialize_osmesa()
+
+        self._make_current()
+
+        # Everything is drawn into an FBO which stands in for the screen
+        self._target = RenderTarget(self._width, self._height, depth=True)
+        state = gl_state()
+        state.default_framebuffer = self._target.framebuffer.id
+        state.bind_framebuffer(state.default_framebuffer)
+        # A surfaceless context starts with a 0x0 viewport
+        state.set_viewport(0, 0, self._width, self._height)
+
+    def _initialize_egl(self):
+        from OpenGL import EGL
+
+        display = _egl_display(EGL)
+
+        # Platforms without a display server may not offer pbuffers;
+        # rendering goes to an FBO anyway, so no surface is fine too
+        surface_types = [[EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT], []]
+        config = EGL.EGLConfig()
+        count = EGL.EGLint()
+        for surface_type in surface_types:
+            config_attribs = _int_array(
+                EGL.EGLint,
+                surface_type +
+                [EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT,
+                 EGL.EGL_RED_SIZE, 8,
+                 EGL.EGL_GREEN_SIZE, 8,
+                 EGL.EGL_BLUE_SIZE, 8,
+                 EGL.EGL_DEPTH_SIZE, 24,
+                 EGL.EGL_NONE]
+            )
+            if EGL.eglChooseConfig(display, config_attribs,
+                                   ctypes.pointer(config), 1,
+                                   ctypes.pointer(count)) and \
+               count.value > 0:
+                break
+        else:
+            _release_egl_display(EGL, display)
+            raise RuntimeError('eglChooseConfig found no OpenGL config')
+
+        surface = EGL.EGL_NO_SURFACE
+        if surface_type:
+            surface_attribs = _int_array(
+                EGL.EGLint,
+                [EGL.EGL_WIDTH, self._width,
+                 EGL.EGL_HEIGHT, self._height,
+                 EGL.EGL_NONE]
+            )
+            surface = EGL.eglCreatePbufferSurface(
+                display, config, surface_attribs) or EGL.EGL_NO_SURFACE
+
+        EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+        context_attribs = _int_array(
+            EGL.EGLint,
+            [EGL.EGL_CONTEXT_MAJOR_VERSION, 3,
+             EGL.EGL_CONTEXT_MINOR_VERSION, 2,
+             EGL.EGL_CONTEXT_OPENGL_PROFILE_MASK,
+             EGL.EGL_CONTEXT_OPENGL_CORE_PROFILE_BIT,
+             EGL.EGL_NONE]
+        )
+        context = EGL.eglCreateContext(
+            display, config, EGL.EGL_NO_CONTEXT, context_attribs)
+        if not context:
+            if surface:
+                EGL.eglDestroySurface(display, surface)
+            _release_egl_display(EGL, display)
+            raise RuntimeError('eglCreateContext failed')
+
+        self._egl = EGL
+        self._display = display
+        self._surface = surface
+        self._context = context
+
+    def _initialize_osmesa(self):
+        from OpenGL import osmesa
+
+        attribs = _int_array(
+            ctypes.c_int,
+            [osmesa.OSMESA_FORMAT, osmesa.OSMESA_RGBA,
+             osmesa.OSMESA_DEPTH_BITS, 24,
+             osmesa.OSMESA_PROFILE, osmesa.OSMESA_CORE_PROFILE,
+             osmesa.OSMESA_CONTEXT_MAJOR_VERSION, 3,
+             osmesa.OSMESA_CONTEXT_MINOR_VERSION, 2,
+             0]
+        )
+        context = osmesa.OSMesaCreateContextAttribs(attribs, None)
+        if not context:
+            raise RuntimeError('OSMesaCreateContextAttribs failed')
+
+        self._osmesa = osmesa
+        self._buffer = np.zeros((self._height, self._width, 4), dtype='uint8')
+        self._context = context
+
+    def _has_context(self):
+        return bool(self._context)
+
+    def _make_current(self):
+        if self._backend == 'egl':
+            self._egl.eglMakeCurrent(
+                self._display, self._surface, self._surface, self._context)
+        else:
+            self._osmesa.OSMesaMakeCurrent(
+                self._context, self._buffer, GL_UNSIGNED_BYTE,
+                self._width, self._height)
+        make_state_current(id(self))
+
+    def _get_framebuffer_size(self):
+        return (self._width, self._height)
+
+    def _set_should_close(self, value):
+        self._close_requested = value
+
+    def _should_close(self):
+        return self._close_requested
+
+    # Finish the frame so timings are not queued up in the driver
+    def _swap_buffers(self):
+        glFlush()
+
+    def _poll_events(self):
+        pass
+
+    def _wait_events(self, timeout):
+        self._redraw.wait(timeout)
+
+    def _wake(self):
+        pass
+
+    def _apply_swap_interval(self):
+        pass
+
+    # May be called from a renderer or another thread to end run_loop
+    def close(self):
+        self._close_requested = True
+        self._redraw.set()
+
+    @property
+    def width(self):
+        return self._width
+
+    @property
+    def height(self):
+        return self._height
+
+    def __del__(self):
+        if not self._context:
+            return
+
+        self._make_current()
+        if self._renderer:
+            self._renderer.dispose()
+        self._target = None
+        release_state(id(self))
+
+        if self._backend == 'egl':
+            EGL = self._egl
+            EGL.eglMakeCurrent(self._display, EGL.EGL_NO_SURFACE,
+                               EGL.EGL_NO_SURFACE, EGL.EGL_NO_CONTEXT)
+            if self._surface:
+                EGL.eglDestroySurface(self._display, self._surface)
+            EGL.eglDestroyContext(self._display, self._context)
+            _release_egl_display(EGL, self._display)
+        else:
+            self._osmesa.OSMesaDestroyContext(self._context)
+        debug('HeadlessGLView is being deleted: {}'.format(self))
+
+
+# Renderers must not keep their view alive: __del__ has to run when the
+# view goes away, on the thread that owns the context, not whenever the
+# cyclic collector happens to run. Arguments (e.g. the glfw window) are
+# dropped.
+def _weak_callback(method):
+    ref = weakref.WeakMethod(method)
+
+    def _callback(*args):
+        method = ref()
+        if method is not None:
+            method()
+    return _callback
+
+
+# PyOpenGL resolves GL entry points through the platform it picked on
+# import (GLX by default on Linux), which must match the headless backend
+def _check_platform(backend):
+    from OpenGL import platform
+
+    name = type(platform.PLATFORM).__name__
+    expected = {'egl': 'EGLPlatform', 'osmesa': 'OSMesaPlatform'}[backend]
+    if name != expected:
+        raise RuntimeError(
+            'headless backend {} needs PYOPENGL_PLATFORM={} set before '
+            'OpenGL is imported, PyOpenGL is using {}'.format(
+                backend, backend, name))
+
+
+_EGL_PLATFORM_DEVICE_EXT = 0x313F
+_EGL_PLATFORM_SURFACELESS_MESA = 0x31DD
+
+# eglInitialize/eglTerminate are not counted by EGL itself: the display
+# is shared by every HeadlessGLView and terminated with the last one
+_egl_displays = {}
+
+
+def _egl_handle(display):
+    return ctypes.cast(display, ctypes.c_void_p).value
+
+
+# Display that works without a display server: Mesa's surfaceless
+# platform, then the first EGL device, then the default display
+def _egl_display(EGL):
+    candidates = []
+    try:
+        from OpenGL.EGL.EXT.platform_base import eglGetPlatformDisplayEXT
+        candidates.append(lambda: eglGetPlatformDisplayEXT(
+            _EGL_PLATFORM_SURFACELESS_MESA, EGL.EGL_DEFAULT_DISPLAY, None))
+
+        def _device_display():
+            from OpenGL.EGL.EXT.device_enumeration import \
+                eglQueryDevicesEXT
+            devices = (EGL.EGLDeviceEXT * 1)()
+            count = EGL.EGLint()
+            if not eglQueryDevicesEXT(1, devices, ctypes.pointer(count)) \
+               or count.value < 1:
+                return EGL.EGL_NO_DISPLAY
+            return eglGetPlatformDisplayEXT(
+                _EGL_PLATFORM_DEVICE_EXT, devices[0], None)
+        candidates.append(_device_display)
+    except ImportError:
+        pass
+    candidates.append(lambda: EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY))
+
+    for candidate in candidates:
+        try:
+            display = candidate()
+        except Exception as e:
+            # Missing extension entry points raise instead of returning
+            debug('EGL display unavailable: {}'.format(e))
+            continue
+        if not display:
+            continue
+
+        handle = _egl_handle(display)
+        if handle in _egl_displays:
+            _egl_displays[handle] += 1
+            return display
+
+        major, minor = EGL.EGLint(), EGL.EGLint()
+        if EGL.eglInitialize(display, ctypes.pointer(major),
+                             ctypes.pointer(minor)):
+            _egl_displays[handle] = 1
+            return display
+
+    raise RuntimeError('eglInitialize failed on every EGL platform')
+
+
+def _release_egl_display(EGL, display):
+    handle = _egl_handle(display)
+    count = _egl_displays.get(handle, 1) - 1
+    if count > 0:
+        _egl_displays[handle] = count
+        return
+    _egl_displays.pop(handle, None)
+    EGL.eglTerminate(display)
+
+
+def _int_array(ctype, values):
+    return (ctype * len(values))(*values)
+
+
 class EventListener:
 
     def __init__(self):
@@ -1,11 +1,12 @@
 import cyglfw3 as glfw
 import os
+import struct
 
 from OpenGL.GL import *
 from PIL import Image
 from threading import Timer
 
-from glview import GLView
+from glview import GLView, HeadlessGLView
 from renderer import *
 
 
@@ -22,14 +23,115 @@ def glview_test():
 
     with Image.open('./image/psh.jpg') as img:
         data = np.asarray(img, dtype='uint8')
-        data = data[::-1, ...]
         t3 = Timer(9.0, _change_renderer,
-                   (glview, TextureRenderer(image=data)))
+                   (glview, TextureRenderer(image=data, flip=True)))
         t3.start()
 
     glview.run_loop()
 
 
+def headless_test(frames=60, path='./headless.png'):
+    glview = HeadlessGLView(512, 512, renderer=TriangleRenderer())
+    glview.run_loop(max_frames=frames)
+
+    # Rows come bottom-up from GL
+    data = glview.snapshot()
+    Image.fromarray(data[::-1, ...]).save(path)
+
+
+# Runs check() once inside a frame, with the view's context current
+class CheckRenderer(Renderer):
+
+    def __init__(self, check):
+        super().__init__(vs_path=None, fs_path=None, name='check')
+        self.check = check
+        self.done = False
+
+    def prepare(self):
+        pass
+
+    def render(self):
+        self.check()
+        self.done = True
+
+
+# Two frames through every YUVTexture layout. Elided binds used to leave
+# the last plane's unit active, so the second Y upload hit that texture.
+def yuv_upload_test(width=64, height=32):
+    checker = CheckRenderer(lambda: _check_yuv_upload(width, height))
+    glview = HeadlessGLView(width, height, renderer=checker)
+    glview.run_loop(max_frames=1)
+    assert checker.done
+
+    print('yuv_upload_test passed')
+
+
+def _check_yuv_upload(width, height):
+    for layout in YUVTexture.layouts:
+        texture = YUVTexture(layout=layout)
+        if layout == 'yuyv':
+            size = width * height * 2
+        else:
+            size = width * height * 3 // 2
+        for value in (16, 235):
+            frame = np.full(size, value, dtype='uint8')
+            texture.update(frame, width, height)
+
+        luma = texture.planes[0]
+        luma.bind()
+        data = glGetTexImage(GL_TEXTURE_2D, 0, GL_RED, GL_UNSIGNED_BYTE)
+        data = np.frombuffer(bytes(data), dtype='uint8')
+        assert data.size == width * height, layout
+        assert np.all(data == 235), layout
+
+
+# Collect GPU timings of real frames; the results are read back through
+# 64-bit queries
+def profiler_test(frames=5):
+    glview = HeadlessGLView(256, 256, renderer=TriangleRenderer())
+    glview.profiler = GPUProfiler()
+    glview.run_loop(max_frames=frames)
+
+    # Reading the frame back makes the context current and waits for the
+    # GPU, so the queries of the last frame are done as well
+    glview.snapshot()
+    glview.profiler.collect()
+    stats = glview.profiler.stats()
+    assert 'TriangleRenderer' in stats, stats
+    assert stats['TriangleRenderer']['count'] >= 1, stats
+    print(glview.profiler.to_json())
+    print('profiler_test passed')
+
+
+# A corrupted cache entry has to fall back to compiling from source
+def binary_cache_test(dirpath='./cache/test'):
+    renderer = TriangleRenderer()
+    renderer.binary_cache = ProgramBinaryCache(dirpath)
+    glview = HeadlessGLView(64, 64, renderer=renderer)
+    glview.run_loop(max_frames=1)
+    expected = glview.snapshot()
+
+    # Nothing is stored without program binary support
+    if not os.path.isdir(dirpath) or not os.listdir(dirpath):
+        print('binary_cache_test skipped: no program binary support')
+        return
+
+    paths = [os.path.join(dirpath, name) for name in os.listdir(dirpath)]
+    for path in paths:
+        with open(path, 'wb') as f:
+            # Unknown binary format followed by garbage
+            f.write(struct.pack('<I', 0xdeadbeef) + os.urandom(64))
+
+    # The next loop prepares the renderer again, through the cache
+    glview.run_loop(max_frames=1)
+    assert np.array_equal(glview.snapshot(), expected), 'frames differ'
+    for path in paths:
+        with open(path, 'rb') as f:
+            binary_format, = struct.unpack('<I', f.read(4))
+        assert binary_format != 0xdeadbeef, 'entry was not replaced'
+    print('binary_cache_test passed')
+
+
 def main():
     # save current working directory
     cwd = os.getcwd()
@@ -60,8 +162,7 @@ def main():
     # renderer = RectangleRenderer()
     with Image.open('./image/psh.jpg') as img:
         data = np.asarray(img, dtype='uint8')
-        data = data[::-1, ...]
-        renderer = TextureRenderer(image=data)
+        renderer = TextureRenderer(image=data, flip=True)
 
     renderer.prepare()
     while not glfw.WindowShouldClose(win):
@@ -78,4 +179,8 @@ def main():
 
 if __name__ == '__main__':
     # main()
+    # headless_test()
+    # yuv_upload_test()
+    # profiler_test()
+    # binary_cache_test()
     glview_test()
@@ -1,13 +1,24 @@
 import cv2
 import numpy as np
+import time
 
-from cvutils import Webcam, FPSChecker
+from cvutils import Webcam, FrameTimer
 from framework import *
 from OpenGL.GL import *
+from tracing import span
 
 
 class Renderer:
 
+    binary_cache = default_binary_cache
+
+    # Queued draws are sorted by layer first, then by GL state
+    layer = 0
+
+    # On-demand rendering: a renderer is redrawn only while dirty
+    _dirty = True
+    _invalidate_callback = None
+
     def __init__(self, vs_path, fs_path, gs_path=None, name=''):
         self.name = name
         self._vs_path = vs_path
@@ -29,15 +40,44 @@ class Renderer:
         self._program = Program(
             vs_code=vs_code,
             fs_code=fs_code,
-            gs_code=gs_code
+            gs_code=gs_code,
+            binary_cache=self.binary_cache
         )
 
+    @property
+    def label(self):
+        return self.name or type(self).__name__
+
     def reshape(self, w, h):
-        glViewport(0, 0, w, h)
+        gl_state().set_viewport(0, 0, w, h)
 
     def render(self):
         pass
 
+    # Flag the renderer for redraw, may be called from any thread
+    def invalidate(self):
+        self._dirty = True
+        if self._invalidate_callback:
+            self._invalidate_callback()
+
+    def needs_render(self):
+        return self._dirty
+
+    def clear_dirty(self):
+        self._dirty = False
+
+    def set_invalidate_callback(self, callback):
+        self._invalidate_callback = callback
+
+    # Add draw items to a RenderQueue. Renderers that do not describe
+    # their state are queued as one opaque item calling render().
+    def submit(self, queue):
+        queue.submit(
+            lambda program: self.render(),
+            layer=self.layer,
+            name=self.label
+        )
+
     def dispose(self):
         self._program = None
 
@@ -47,6 +87,7 @@ class RendererGroup(Renderer):
     def __init__(self, name=''):
         self.name = name
         self.renderers = []
+        self.queue = RenderQueue()
 
     def prepare(self):
         for r in self.renderers:
@@ -57,14 +98,111 @@ class RendererGroup(Renderer):
             r.reshape(w, h)
 
     def render(self):
+        self.submit(self.queue)
+        self.queue.flush()
+
+    def submit(self, queue):
+        for r in self.renderers:
+            r.submit(queue)
+
+    def needs_render(self):
+        return any([r.needs_render() for r in self.renderers])
+
+    def clear_dirty(self):
+        for r in self.renderers:
+            r.clear_dirty()
+
+    def set_invalidate_callback(self, callback):
         for r in self.renderers:
-            r.render()
+            r.set_invalidate_callback(callback)
+
+    @property
+    def stats(self):
+        return self.queue.stats
 
     def dispose(self):
         for r in self.renderers:
             r.dispose()
 
 
+class TiledRendererGroup(RendererGroup):
+
+    # columns: tiles per row, None picks a near-square grid
+    # capture: cvutils.CaptureManager advanced once per frame, so all
+    #   tiles show one aligned frame set
+    def __init__(self, name='', columns=None, capture=None):
+        super().__init__(name=name)
+        self.columns = columns
+        self.capture = capture
+        self._size = (0, 0)
+
+    # Viewport (x, y, w, h) of every tile, the first one at the top-left
+    def tiles(self):
+        count = max(len(self.renderers), 1)
+        columns = self.columns or int(np.ceil(np.sqrt(count)))
+        rows = int(np.ceil(count / columns))
+        w, h = self._size
+        tw, th = w // columns, h // rows
+        return [
+            (i % columns * tw, h - (i // columns + 1) * th, tw, th)
+            for i in range(len(self.renderers))
+        ]
+
+    # Texture renderers of the same type share one program and quad
+    def prepare(self):
+        shared = {}
+        for r in self.renderers:
+            if isinstance(r, TextureRenderer):
+                r.share_with = shared.setdefault(type(r), r)
+                if r.share_with is r:
+                    r.share_with = None
+            r.prepare()
+
+    def reshape(self, w, h):
+        self._size = (w, h)
+        for r, tile in zip(self.renderers, self.tiles()):
+            r.reshape(tile[2], tile[3])
+        gl_state().set_viewport(0, 0, w, h)
+
+    def render(self):
+        if self.capture:
+            with span('capture.align'):
+                self.capture.read()
+        super().render()
+        gl_state().set_viewport(0, 0, *self._size)
+
+    def submit(self, queue):
+        for r, tile in zip(self.renderers, self.tiles()):
+            if isinstance(r, TextureRenderer):
+                r._update_texture()
+                queue.submit(
+                    lambda program, r=r, tile=tile: self._draw_tile(
+                        r._draw, program, tile),
+                    program=r._program,
+                    vertex_object=r._vertex_object,
+                    textures=[r.texture],
+                    layer=r.layer,
+                    name=r.label
+                )
+            else:
+                queue.submit(
+                    lambda program, r=r, tile=tile: self._draw_tile(
+                        lambda __: r.render(), program, tile),
+                    layer=r.layer,
+                    name=r.label
+                )
+
+    def _draw_tile(self, draw, program, tile):
+        gl_state().set_viewport(*tile)
+        draw(program)
+
+    def dispose(self):
+        super().dispose()
+        for r in self.renderers:
+            if isinstance(r, TextureRenderer):
+                r.share_with = None
+
+
 class TriangleRenderer(Renderer):
 
     default_vs_path = './shader/basic_color.vs'
@@ -89,10 +227,22 @@ class TriangleRenderer(Renderer):
         )
         self._vertex_object = VertexObject(v, [3, 3])
 
+    def _draw(self, program):
+        glDrawArrays(GL_TRIANGLES, 0, self._vertex_object.count)
+
     def render(self):
-        with self._program:
-            with self._vertex_object as vo:
-                glDrawArrays(GL_TRIANGLES, 0, vo.count)
+        with self._program as program:
+            with self._vertex_object:
+                self._draw(program)
+
+    def submit(self, queue):
+        queue.submit(
+            self._draw,
+            program=self._program,
+            vertex_object=self._vertex_object,
+            layer=self.layer,
+            name=self.label
+        )
 
     def dispose(self):
         super().dispose()
@@ -129,37 +279,341 @@ class RectangleRenderer(Renderer):
         )
         self._vertex_object = VertexObject(v, [3, 3], e)
 
+    def _draw(self, program):
+        vo = self._vertex_object
+        glDrawElements(
+            GL_TRIANGLES,
+            vo.count,
+            vo.index_type,
+            None
+        )
+
     def render(self):
-        with self._program:
-            with self._vertex_object as vo:
-                glDrawElements(
-                    GL_TRIANGLES,
-                    vo.count,
-                    GL_UNSIGNED_BYTE,
-                    None
-                )
+        with self._program as program:
+            with self._vertex_object:
+                self._draw(program)
+
+    def submit(self, queue):
+        queue.submit(
+            self._draw,
+            program=self._program,
+            vertex_object=self._vertex_object,
+            layer=self.layer,
+            name=self.label
+        )
+
+    def dispose(self):
+        super().dispose()
+        self._vertex_object = None
+
+
+class LandmarkRenderer(Renderer):
+
+    default_vs_path = './shader/instanced_point.vs'
+    default_fs_path = './shader/basic_color.fs'
+
+    # image_size: (width, height) the landmark coordinates refer to
+    def __init__(self, name='', image_size=(1280, 720),
+                 point_size=3.0, color=(1.0, 0.0, 0.0)):
+        super().__init__(
+            vs_path=self.default_vs_path,
+            fs_path=self.default_fs_path,
+            name=name
+        )
+        self.image_size = image_size
+        self.point_size = point_size
+        self.color = color
+
+        self._next_landmarks = None
+        self._instances = None
+        self._vertex_object = None
+        self._stream = None
+        self._streaming = False
+
+    @property
+    def landmarks(self):
+        return self._next_landmarks
+
+    # landmarks: array of (..., 2) points, e.g. (faces, 68, 2)
+    @landmarks.setter
+    def landmarks(self, value):
+        if value is self._next_landmarks:
+            return
+        self._next_landmarks = value
+        self.invalidate()
+
+    def prepare(self):
+        super().prepare()
+
+        v = np.array(
+            [-0.5, -0.5,
+             +0.5, -0.5,
+             -0.5, +0.5,
+             +0.5, +0.5],
+            dtype='float32'
+        )
+        e = np.array(
+            [0, 1, 2,
+             1, 3, 2],
+            dtype='uint8'
+        )
+        self._vertex_object = VertexObject(
+            v, [2], e,
+            instance_alignment=[2, 3]
+        )
+        # 3 frames of room for 16 faces of 68 points, grown on demand
+        self._stream = StreamBuffer(capacity=3 * 16 * 68 * 5 * 4)
+        self._streaming = False
+
+    def _update_instances(self):
+        if self._next_landmarks is not None:
+            points = np.asarray(self._next_landmarks, dtype='float32')
+            points = points.reshape(-1, 2)
+            instances = np.empty((points.shape[0], 5), dtype='float32')
+            instances[:, :2] = points
+            instances[:, 2:] = self.color
+            self._instances = instances
+            self._next_landmarks = None
+
+        if self._instances is None or len(self._instances) == 0:
+            self._vertex_object.instance_count = 0
+            return
+
+        # Written into this frame's ring region every frame, so a region
+        # is never read after its fence and the landmarks can stay put
+        if self._instances.nbytes > self._stream.segment_size:
+            self._stream = StreamBuffer(
+                capacity=3 * 2 * self._instances.nbytes)
+        self._stream.begin()
+        view, offset = self._stream.allocate(self._instances.shape)
+        view[...] = self._instances
+        self._stream.commit()
+        self._vertex_object.stream_instances(
+            self._stream, offset, len(self._instances))
+        self._streaming = True
+
+    def _draw(self, program):
+        program.setVec2f('imageSize', self.image_size)
+        program.setFloat('pointSize', self.point_size)
+        self._vertex_object.draw_instanced()
+
+        # Fence the region after the draw reading it
+        if self._streaming:
+            self._stream.end()
+            self._streaming = False
+
+    def render(self):
+        self._update_instances()
+
+        with self._program as program:
+            with self._vertex_object:
+                self._draw(program)
+
+    def submit(self, queue):
+        self._update_instances()
+
+        queue.submit(
+            self._draw,
+            program=self._program,
+            vertex_object=self._vertex_object,
+            layer=self.layer,
+            name=self.label
+        )
 
     def dispose(self):
         super().dispose()
         self._vertex_object = None
+        self._stream = None
+        self._instances = None
+
+
+class FrameTimeRenderer(Renderer):
+
+    default_vs_path = './shader/overlay.vs'
+    default_fs_path = './shader/overlay.fs'
+
+    # Drawn over the video in a RendererGroup
+    layer = 1
+
+    # frame_timer: cvutils.FrameTimer to display
+    # position, size: placement in pixels from the top-left corner
+    # interval: seconds between label updates
+    def __init__(self, frame_timer, name='', position=(10, 10),
+                 size=(320, 120), interval=0.5):
+        super().__init__(
+            vs_path=self.default_vs_path,
+            fs_path=self.default_fs_path,
+            name=name
+        )
+        self.frame_timer = frame_timer
+        self.position = position
+        self.size = size
+        self.interval = interval
+        self.label_height = 24
+
+        self._viewport = (1, 1)
+        self._label_time = 0.0
+        self._quad = None
+        self._graph = None
+        self._stream = None
+        self._label = None
+
+    def prepare(self):
+        super().prepare()
+
+        v = np.array(
+            [0.0, 0.0,
+             1.0, 0.0,
+             0.0, 1.0,
+             1.0, 1.0],
+            dtype='float32'
+        )
+        e = np.array(
+            [0, 1, 2,
+             1, 3, 2],
+            dtype='uint8'
+        )
+        self._quad = VertexObject(v, [2], e)
+        # The graph points live in the stream buffer ring, the vertex
+        # object only keeps the attribute layout
+        self._graph = VertexObject(np.zeros(2, dtype='float32'), [2])
+        self._stream = StreamBuffer(
+            capacity=3 * self.frame_timer.capacity * 2 * 4)
+        self._label = Texture()
+        self._label_time = 0.0
+
+    def reshape(self, w, h):
+        super().reshape(w, h)
+        self._viewport = (max(w, 1), max(h, 1))
+
+    # Pixels from the top-left corner to (x, y, w, h) in NDC
+    def _rect(self, x, y, w, h):
+        vw, vh = self._viewport
+        return np.array(
+            [x / vw * 2.0 - 1.0,
+             1.0 - (y + h) / vh * 2.0,
+             w / vw * 2.0,
+             h / vh * 2.0],
+            dtype='float32'
+        )
+
+    # Text is rasterized into its own small texture, never into the frame
+    def _update_label(self):
+        now = time.perf_counter()
+        if now - self._label_time < self.interval:
+            return
+        self._label_time = now
+
+        stats = self.frame_timer.stats()
+        if stats:
+            text = '{:5.1f} fps  p95 {:4.1f}  max {:4.1f} ms  {} late'.format(
+                stats['fps'], stats['p95'], stats['longest'],
+                stats['over_budget'])
+        else:
+            text = 'waiting for frames'
+
+        image = np.zeros((self.label_height, self.size[0], 4), dtype='uint8')
+        cv2.putText(
+            image,
+            text,
+            (4, self.label_height - 8),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.4,
+            (255, 255, 255, 255),
+            1,
+            cv2.LINE_AA
+        )
+        self._label.update(image=image)
+
+    # Frame times as a line strip, the budget sits at half height
+    def _update_graph(self):
+        samples = self.frame_timer.samples
+        if samples.size < 2:
+            return 0
+
+        self._stream.begin()
+        points, offset = self._stream.allocate((samples.size, 2))
+        points[:, 0] = np.linspace(0.0, 1.0, samples.size)
+        points[:, 1] = np.clip(
+            samples / (2.0 * self.frame_timer.budget), 0.0, 1.0)
+        self._stream.commit()
+        self._graph.stream_vertices(self._stream, offset, samples.size)
+        return samples.size
+
+    def render(self):
+        self._update_label()
+        count = self._update_graph()
+
+        x, y = self.position
+        w, h = self.size
+        lh = self.label_height
+        graph_h = h - lh
+
+        glEnable(GL_BLEND)
+        glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+        with self._program as program:
+            program.setInt('useTexture', 0)
+            with self._quad as quad:
+                program.setVec4f('rect', self._rect(x, y, w, h))
+                program.setVec4f('overlayColor', (0.0, 0.0, 0.0, 0.5))
+                quad.draw()
+
+                program.setVec4f(
+                    'rect', self._rect(x, y + lh + graph_h / 2, w, 1))
+                program.setVec4f('overlayColor', (1.0, 0.8, 0.0, 0.8))
+                quad.draw()
+
+            if count > 0:
+                with self._graph:
+                    program.setVec4f('rect', self._rect(x, y + lh, w, graph_h))
+                    program.setVec4f('overlayColor', (0.2, 1.0, 0.2, 1.0))
+                    glDrawArrays(GL_LINE_STRIP, 0, count)
+                self._stream.end()
+
+            with self._quad as quad:
+                with self._label as label:
+                    program.setInt('useTexture', 1)
+                    program.setSampler('labelTexture', label.unit_number)
+                    program.setVec4f('rect', self._rect(x, y, w, lh))
+                    program.setVec4f('overlayColor', (1.0, 1.0, 1.0, 1.0))
+                    quad.draw()
+        glDisable(GL_BLEND)
+
+    def dispose(self):
+        super().dispose()
+        self._quad = None
+        self._graph = None
+        self._stream = None
+        self._label = None
 
 
 class TextureRenderer(Renderer):
 
     default_vs_path = './shader/basic_tex.vs'
     default_fs_path = './shader/basic_tex.fs'
+    texture_options = {}
 
-    def __init__(self, name='', image=None):
+    # channel_order: 'rgb' or 'bgr' layout of the given images
+    # flip: flip vertically in the shader instead of on the CPU
+    def __init__(self, name='', image=None, channel_order='rgb', flip=False):
         super().__init__(
             vs_path=self.default_vs_path,
             fs_path=self.default_fs_path,
             name=name
         )
 
+        self.channel_order = channel_order
+        self.flip = flip
+
         self._image = None
         self._next_image = None
         self._vertex_object = None
         self._texture = None
+        self._source_texture = None
+
+        # Prepared renderer of the same kind whose program and quad are
+        # reused instead of building copies
+        self.share_with = None
 
         self.image = image
 
@@ -167,11 +621,36 @@ class TextureRenderer(Renderer):
     def image(self):
         return self._image
 
+    @property
+    def texture(self):
+        if self._source_texture is not None:
+            return self._source_texture
+        return self._texture
+
+    # Draw an existing texture (e.g. a render target) instead of image
+    @texture.setter
+    def texture(self, value):
+        if value is self._source_texture:
+            return
+        self._source_texture = value
+        self.invalidate()
+
+    # The same buffer may carry a new frame, so it is always uploaded
     @image.setter
     def image(self, value):
+        changed = value is not self._next_image and value is not self._image
         self._next_image = value
+        if changed:
+            self.invalidate()
 
     def prepare(self):
+        shared = self.share_with
+        if shared is not None and shared._program is not None:
+            self._program = shared._program
+            self._vertex_object = shared._vertex_object
+            self._texture = Texture(**self.texture_options)
+            return
+
         super().prepare()
         v = np.array(
             [-1.0, -1.0, +0.0, 0.0, 0.0,
@@ -186,25 +665,49 @@ class TextureRenderer(Renderer):
             dtype='uint8'
         )
         self._vertex_object = VertexObject(v, [3, 2], e)
-        self._texture = Texture()
+        self._texture = Texture(**self.texture_options)
 
-    def render(self):
+    def _update_texture(self):
         if self._next_image is not None:
             self._image = self._next_image
-            self._texture.update(image=self._image)
+            with span('texture.update'):
+                self._texture.update(
+                    image=self._image,
+                    channel_order=self.channel_order
+                )
 
             self._next_image = None
 
+    def _draw(self, program):
+        vo = self._vertex_object
+        program.setSampler('inputTexture', self.texture.unit_number)
+        program.setInt('flipVertical', int(self.flip))
+        glDrawElements(
+            GL_TRIANGLES,
+            vo.count,
+            vo.index_type,
+            None
+        )
+
+    def render(self):
+        self._update_texture()
+
         with self._program as program:
-            with self._vertex_object as vo:
-                with self._texture as tex:
-                    program.setInt('inputTexture', tex.unit_number)
-                    glDrawElements(
-                        GL_TRIANGLES,
-                        vo.count,
-                        GL_UNSIGNED_BYTE,
-                        None
-                    )
+            with self._vertex_object:
+                with self.texture:
+                    self._draw(program)
+
+    def submit(self, queue):
+        self._update_texture()
+
+        queue.submit(
+            self._draw,
+            program=self._program,
+            vertex_object=self._vertex_object,
+            textures=[self.texture],
+            layer=self.layer,
+            name=self.label
+        )
 
     def dispose(self):
         super().dispose()
@@ -216,25 +719,467 @@ class TextureRenderer(Renderer):
 
 class VideoRenderer(TextureRenderer):
 
+    # Frames are streamed through a ring of pixel unpack buffers
+    texture_options = {'pbo_count': 3}
+
+    # frame_block: callable(image) returning the image to upload, run on
+    #   the render thread; preprocessing belongs in the source's steps
+    # frame_hook: callable(frame, image) like frame_block, for hooks that
+    #   also need the cvutils.Frame (sequence, timestamp, variants)
+    # Both get a copy owned by the renderer and may draw into it; the
+    # ring slot is shared with other consumers.
+    # variant: Frame variant to upload, None for the captured image
+    # channel_order, flip: layout of the uploaded image; OpenCV frames are
+    #   BGR and top-down, both handled on the GPU
+    # processor: cvutils.AsyncProcessor fed with every new frame, so slow
+    #   work never holds up the display
+    # composite: callable(image, result) drawing the latest completed
+    #   result of the processor into a copy of the newest frame owned by
+    #   the renderer; the ring slot is shared with other consumers
     def __init__(self,
                  name='',
                  image=None,
                  video_source=None,
-                 frame_block=None):
-        super().__init__(name=name, image=image)
+                 frame_block=None,
+                 frame_hook=None,
+                 variant=None,
+                 channel_order='bgr',
+                 flip=True,
+                 processor=None,
+                 composite=None):
+        super().__init__(
+            name=name,
+            image=image,
+            channel_order=channel_order,
+            flip=flip
+        )
 
         self.video_source = video_source
-        self.fps_checker = FPSChecker()
+        self.frame_timer = FrameTimer()
         self.frame_block = frame_block
+        self.frame_hook = frame_hook
+        self.variant = variant
+        self.processor = processor
+        self.composite = composite
+        self._sequence = None
+        self._draw_buffer = None
 
-    def render(self):
-        image = self.video_source.frame
+    def prepare(self):
+        super().prepare()
+        self._sequence = None
+        self.video_source.frame_listeners.append(self.invalidate)
+
+    def needs_render(self):
+        return self._dirty or \
+            self.video_source.sequence != self._sequence
+
+    def _update_texture(self):
+        # Nothing new from the source: keep the uploaded frame
+        frame = self.video_source.read(id(self))
+        image = None
+        if frame is not None and frame.seq != self._sequence:
+            self._sequence = frame.seq
+            image = frame.variant(self.variant)
         if image is not None:
             if self.frame_block:
-                image = self.frame_block(image)
-            self.fps_checker.lab(image)
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            image = image[::-1, ...]
+                with span('video.frame_block'):
+                    image = self.frame_block(self._drawable(image))
+            if self.frame_hook:
+                with span('video.frame_block'):
+                    image = self.frame_hook(frame, self._drawable(image))
+            if self.processor:
+                self.processor.submit(frame)
+                result = self.processor.result
+                if self.composite and result is not None:
+                    with span('video.composite'):
+                        image = self.composite(self._drawable(image), result)
+            self.frame_timer.lab()
             self.image = image
 
-        super().render()
+        super()._update_texture()
+
+    # Copy into a buffer reused across frames, safe to draw into
+    def _drawable(self, image):
+        buffer = self._draw_buffer
+        if buffer is None or buffer.shape != image.shape or \
+                buffer.dtype != image.dtype:
+            buffer = self._draw_buffer = np.empty_like(image)
+        if buffer is not image:
+            np.copyto(buffer, image)
+        return buffer
+
+    def dispose(self):
+        if self.invalidate in self.video_source.frame_listeners:
+            self.video_source.frame_listeners.remove(self.invalidate)
+        self.video_source.release(id(self))
+        self._draw_buffer = None
+        super().dispose()
+
+
+class YUVVideoRenderer(TextureRenderer):
+
+    default_fs_path = './shader/yuv.fs'
+
+    # Limited range YUV -> RGB, row-major
+    matrices = {
+        'bt601': np.array(
+            [[1.164, 0.000, 1.596],
+             [1.164, -0.392, -0.813],
+             [1.164, 2.017, 0.000]],
+            dtype='float32'
+        ),
+        'bt709': np.array(
+            [[1.164, 0.000, 1.793],
+             [1.164, -0.213, -0.533],
+             [1.164, 2.112, 0.000]],
+            dtype='float32'
+        ),
+    }
+    offset = np.array([16.0 / 255, 128.0 / 255, 128.0 / 255], dtype='float32')
+
+    # layout: 'nv12', 'i420' or 'yuyv', guessed from the source FOURCC if None
+    # matrix: 'bt601' or 'bt709'
+    def __init__(self,
+                 name='',
+                 video_source=None,
+                 layout=None,
+                 matrix='bt601'):
+        super().__init__(name=name, flip=True)
+
+        self.video_source = video_source
+        self.layout = layout
+        self.matrix = matrix
+        self._sequence = None
+
+    def prepare(self):
+        super().prepare()
+        self._sequence = None
+        self.video_source.frame_listeners.append(self.invalidate)
+
+        layout = self.layout
+        if layout is None:
+            layout = YUVTexture.fourcc_layouts.get(
+                self.video_source.fourcc, 'yuyv')
+        self._texture = YUVTexture(layout=layout)
+
+    def needs_render(self):
+        return self._dirty or \
+            self.video_source.sequence != self._sequence
+
+    def dispose(self):
+        if self.invalidate in self.video_source.frame_listeners:
+            self.video_source.frame_listeners.remove(self.invalidate)
+        self.video_source.release(id(self))
+        super().dispose()
+
+    def _update_texture(self):
+        frame = self.video_source.read(id(self))
+        if frame is None or frame.seq == self._sequence:
+            return
+        self._sequence = frame.seq
+
+        if frame.image is not None:
+            with span('texture.update'):
+                self._texture.update(
+                    frame.image,
+                    self.video_source.width,
+                    self.video_source.height
+                )
+
+    def _draw(self, program):
+        vo = self._vertex_object
+        tex = self._texture
+        units = tex.unit_numbers + [0]
+        program.setSampler('yTexture', units[0])
+        program.setSampler('uTexture', units[1])
+        program.setSampler('vTexture', units[2])
+        program.setInt('yuvLayout', tex.layout_index)
+        program.setMat3f('yuvMatrix', self.matrices[self.matrix])
+        program.setVec3f('yuvOffset', self.offset)
+        program.setInt('flipVertical', int(self.flip))
+        glDrawElements(
+            GL_TRIANGLES,
+            vo.count,
+            vo.index_type,
+            None
+        )
+
+
+class RenderPass:
+
+    # inputs/outputs: resource names declared on the RenderGraph,
+    # RenderGraph.SCREEN stands for the default framebuffer
+    def __init__(self, name, inputs=(), outputs=('screen',)):
+        self.name = name
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+
+    # False lets the graph reuse the previous result of this pass
+    def changed(self):
+        return True
+
+    # On-demand rendering, see Renderer
+    def needs_render(self):
+        return self.changed()
+
+    def clear_dirty(self):
+        pass
+
+    def set_invalidate_callback(self, callback):
+        pass
+
+    def prepare(self):
+        pass
+
+    def reshape(self, w, h):
+        pass
+
+    # inputs: resource name -> Texture, the output target is bound
+    def execute(self, inputs):
+        pass
+
+    def dispose(self):
+        pass
+
+
+class RendererPass(RenderPass):
+
+    # static: the renderer output only changes when its inputs do
+    def __init__(self, renderer, inputs=(), outputs=('screen',),
+                 name=None, static=False):
+        super().__init__(
+            name=name or renderer.label,
+            inputs=inputs,
+            outputs=outputs
+        )
+        self.renderer = renderer
+        self.static = static
+
+    def changed(self):
+        return not self.static
+
+    def needs_render(self):
+        return self.renderer.needs_render()
+
+    def clear_dirty(self):
+        self.renderer.clear_dirty()
+
+    def set_invalidate_callback(self, callback):
+        self.renderer.set_invalidate_callback(callback)
+
+    def prepare(self):
+        self.renderer.prepare()
+
+    def reshape(self, w, h):
+        self.renderer.reshape(w, h)
+
+    def execute(self, inputs):
+        # A TextureRenderer draws the first input
+        if self.inputs and hasattr(self.renderer, 'texture'):
+            self.renderer.texture = inputs[self.inputs[0]]
+        self.renderer.render()
+
+    def dispose(self):
+        self.renderer.dispose()
+
+
+class RenderGraph(Renderer):
+
+    SCREEN = 'screen'
+
+    def __init__(self, name=''):
+        self.name = name
+        self.passes = []
+        self.resources = {}
+
+        self._order = None
+        self._groups = {}
+        self._targets = {}
+        self._pool = []
+        self._size = (0, 0)
+        self._valid = False
+
+    # scale: size relative to the screen
+    # persistent: keep a dedicated target so unchanged passes can be skipped
+    def add_resource(self, name, format=GL_RGBA8, scale=1.0, depth=False,
+                     persistent=False):
+        self.resources[name] = {
+            'format': format,
+            'scale': scale,
+            'depth': depth,
+            'persistent': persistent,
+        }
+        self._order = None
+
+    def add_pass(self, render_pass):
+        self.passes.append(render_pass)
+        self._order = None
+        return render_pass
+
+    # Producers run before consumers, ties keep the insertion order
+    def _sort(self):
+        producers = {}
+        for p in self.passes:
+            for name in p.outputs:
+                if name == self.SCREEN:
+                    continue
+                if name not in self.resources:
+                    raise ValueError('unknown resource: {}'.format(name))
+                if name in producers:
+                    raise ValueError(
+                        'resource {} has several producers'.format(name))
+                producers[name] = p
+
+        dependencies = {}
+        for p in self.passes:
+            deps = set()
+            for name in p.inputs:
+                if name not in producers:
+                    raise ValueError('resource {} is never produced'.
+                                     format(name))
+                deps.add(producers[name])
+            dependencies[p] = deps
+
+        order = []
+        done = set()
+        while len(order) < len(self.passes):
+            ready = [p for p in self.passes
+                     if p not in done and dependencies[p] <= done]
+            if not ready:
+                raise ValueError('render graph has a cycle')
+            order.append(ready[0])
+            done.add(ready[0])
+
+        return order
+
+    # Group outputs of each pass into one target and give transient
+    # groups whose lifetimes do not overlap the same target
+    def compile(self):
+        self._order = self._sort()
+
+        last_use = {}
+        for i, p in enumerate(self._order):
+            for name in p.inputs:
+                last_use[name] = i
+
+        self._groups = {}
+        free = {}
+        busy = []
+        for i, p in enumerate(self._order):
+            outputs = [name for name in p.outputs if name != self.SCREEN]
+
+            # Release transient targets nobody reads from now on
+            for group in list(busy):
+                key, end, slot = group
+                if end < i:
+                    free.setdefault(key, []).append(slot)
+                    busy.remove(group)
+
+            if not outputs:
+                continue
+
+            resources = [self.resources[name] for name in outputs]
+            key = (
+                tuple([r['format'] for r in resources]),
+                resources[0]['scale'],
+                any([r['depth'] for r in resources]),
+            )
+            persistent = any([r['persistent'] for r in resources])
+            if not persistent and free.get(key):
+                slot = free[key].pop()
+            else:
+                slot = len(self._groups)
+
+            self._groups[p] = (key, slot, persistent)
+            if not persistent:
+                end = max([last_use.get(name, i) for name in outputs])
+                busy.append((key, end, slot))
+
+        self._targets = {}
+        self._valid = False
+        debug('render graph {}: {}'.format(
+            self.name, [p.name for p in self._order]))
+
+    # Index of the target a pass renders into after compile(); passes with
+    # the same index share one RenderTarget. None for screen-only passes.
+    def target_slot(self, render_pass):
+        group = self._groups.get(render_pass)
+        return group[1] if group else None
+
+    def _target_of(self, p):
+        key, slot, _ = self._groups[p]
+        target = self._targets.get(slot)
+        formats, scale, depth = key
+        w = self._size[0] * scale
+        h = self._size[1] * scale
+        if target is None:
+            target = RenderTarget(w, h, color_formats=formats, depth=depth)
+            self._targets[slot] = target
+        else:
+            target.resize(w, h)
+        return target
+
+    def prepare(self):
+        for p in self.passes:
+            p.prepare()
+        self.compile()
+
+    def reshape(self, w, h):
+        self._size = (w, h)
+        for p in self.passes:
+            p.reshape(w, h)
+        self._valid = False
+
+    def needs_render(self):
+        return not self._valid or \
+            any([p.needs_render() for p in self.passes])
+
+    def clear_dirty(self):
+        for p in self.passes:
+            p.clear_dirty()
+
+    def set_invalidate_callback(self, callback):
+        for p in self.passes:
+            p.set_invalidate_callback(callback)
+
+    def render(self):
+        if self._order is None:
+            self.compile()
+
+        state = gl_state()
+        textures = {}
+        changed = set()
+        for p in self._order:
+            group = self._groups.get(p)
+            target = self._target_of(p) if group else None
+            if target:
+                for name, texture in zip(
+                        [n for n in p.outputs if n != self.SCREEN],
+                        target.textures):
+                    textures[name] = texture
+
+            # Only passes owning their targets keep results between frames
+            reusable = group is not None and group[2] and \
+                self.SCREEN not in p.outputs
+            if reusable and self._valid and not p.changed() and \
+               not changed.intersection(p.inputs):
+                continue
+
+            inputs = {name: textures[name] for name in p.inputs}
+            with profile_section(p.name):
+                if target:
+                    with target:
+                        target.clear()
+                        p.execute(inputs)
+                else:
+                    state.bind_framebuffer(state.default_framebuffer)
+                    p.execute(inputs)
+
+            changed.update(p.outputs)
+
+        self._valid = True
+
+    def dispose(self):
+        for p in self.passes:
+            p.dispose()
+        self._targets = {}
@@ -0,0 +1,188 @@
+import numpy as np
+import time
+
+from threading import Event
+
+from cvutils import AsyncProcessor, CaptureManager, Frame, SyntheticSource
+from framework import RenderQueue
+from renderer import RenderGraph, RenderPass
+
+
+# Checks of the frame pipeline and the render scheduling through the
+# public API. None of them needs a GL context or a camera.
+
+
+# A held slot is never written until it is released, and lockstep hands
+# out every frame in order
+def slot_hold_check(frames=10):
+    source = SyntheticSource(64, 32, fps=None, realtime=False, slots=4)
+    held = source.read('held')
+    seq = held.seq
+    pixels = np.copy(held.image)
+
+    source.start()
+    try:
+        last = seq
+        for _ in range(frames):
+            frame = source.wait_for_frame(last, timeout=1.0,
+                                          consumer='reader')
+            assert frame is not None, 'no frame after {}'.format(last)
+            assert frame.seq == last + 1, (frame.seq, last)
+            last = frame.seq
+            assert held.seq == seq, held.seq
+            assert np.array_equal(held.image, pixels)
+
+        # Released: the ring gets the slot back within a lap
+        source.release('held')
+        for _ in range(frames):
+            frame = source.wait_for_frame(last, timeout=1.0,
+                                          consumer='reader')
+            assert frame is not None, 'no frame after {}'.format(last)
+            last = frame.seq
+        assert held.seq != seq, 'released slot was never reused'
+    finally:
+        source.stop()
+
+    print('slot_hold_check passed')
+
+
+# Frames of a set lie within the tolerance of its reference, and a source
+# that stopped delivering is marked stale instead of holding the rest back
+def capture_alignment_check(sets=30):
+    # Enough slots for the fast source to reach back a whole frame of the
+    # slow one
+    sources = [
+        SyntheticSource(64, 32, fps=60.0, slots=6),
+        SyntheticSource(64, 32, fps=30.0, slots=4),
+        SyntheticSource(64, 32, fps=30.0, frames=1),
+    ]
+    manager = CaptureManager(sources)
+    channels = [manager.channel(i) for i in range(len(sources))]
+
+    with manager:
+        # Let the stopped source fall behind by more than max_lag
+        time.sleep(manager.max_lag * 2)
+        for _ in range(sets):
+            frame_set = manager.read()
+            assert frame_set is not None
+            for i in range(2):
+                frame = frame_set.frames[i]
+                assert not frame_set.stale[i], manager.stats
+                skew = abs(frame.timestamp - frame_set.timestamp)
+                assert skew <= manager.tolerance, skew
+                assert channels[i].sequence == frame.seq
+            assert frame_set.stale[2]
+            time.sleep(1.0 / 30)
+
+    print('capture_alignment_check passed')
+
+
+# A full processor replaces the oldest queued frame, never the one being
+# processed, and its result is the newest frame's
+def async_drop_check():
+    gate = Event()
+    started = Event()
+    finished = Event()
+
+    def _process(frame):
+        started.set()
+        gate.wait(1.0)
+        return frame.seq
+
+    def _result():
+        if processor.result_seq == 3:
+            finished.set()
+
+    processor = AsyncProcessor(_process, workers=1, max_in_flight=2)
+    processor.result_listeners.append(_result)
+    image = np.zeros((4, 4, 3), dtype='uint8')
+
+    processor.start()
+    try:
+        assert processor.submit(Frame(image, 0, time.perf_counter()))
+        assert started.wait(1.0)
+        for seq in (1, 2, 3):
+            assert processor.submit(Frame(image, seq, time.perf_counter()))
+        assert processor.in_flight == 2, processor.in_flight
+
+        gate.set()
+        assert finished.wait(1.0), processor.stats()
+    finally:
+        processor.stop()
+
+    stats = processor.stats()
+    assert processor.result == 3, processor.result
+    assert stats['submitted'] == 4, stats
+    assert stats['processed'] == 2, stats
+    assert stats['dropped'] == 2, stats
+    print('async_drop_check passed')
+
+
+# Transient targets are shared once nobody reads them any more;
+# persistent ones are never shared
+def render_graph_alias_check():
+    for persistent in (False, True):
+        graph = RenderGraph()
+        graph.add_resource('a')
+        graph.add_resource('b')
+        graph.add_resource('c', persistent=persistent)
+        p1 = graph.add_pass(RenderPass('p1', outputs=('a',)))
+        p2 = graph.add_pass(RenderPass('p2', inputs=('a',), outputs=('b',)))
+        p3 = graph.add_pass(RenderPass('p3', inputs=('b',), outputs=('c',)))
+        p4 = graph.add_pass(RenderPass('p4', inputs=('c',)))
+        graph.compile()
+
+        assert graph.target_slot(p1) != graph.target_slot(p2)
+        assert graph.target_slot(p2) != graph.target_slot(p3)
+        assert graph.target_slot(p4) is None
+        aliased = graph.target_slot(p1) == graph.target_slot(p3)
+        assert aliased != persistent, (persistent, aliased)
+
+    print('render_graph_alias_check passed')
+
+
+class _Bindable:
+
+    def __init__(self, id, log):
+        self.id = id
+        self.log = log
+
+    def bind(self):
+        self.log.append('bind {}'.format(self.id))
+
+
+# Items are grouped by state within a layer, but never moved across an
+# opaque item
+def render_queue_order_check():
+    log = []
+    p1, p2 = _Bindable(1, log), _Bindable(2, log)
+    v1, v2 = _Bindable(11, log), _Bindable(12, log)
+
+    def _draw(name):
+        return lambda program: log.append(name)
+
+    queue = RenderQueue()
+    queue.submit(_draw('overlay'), program=p1, vertex_object=v1, layer=1)
+    queue.submit(_draw('a'), program=p2, vertex_object=v1)
+    queue.submit(_draw('b'), program=p1, vertex_object=v2)
+    queue.submit(_draw('c'), program=p1, vertex_object=v1)
+    queue.submit(_draw('opaque'))
+    queue.submit(_draw('d'), program=p1, vertex_object=v1)
+    stats = queue.flush()
+
+    draws = [entry for entry in log if not entry.startswith('bind')]
+    assert draws == ['c', 'b', 'a', 'opaque', 'd', 'overlay'], draws
+    assert stats['draw_calls'] == 6, stats
+    # p1 for c and b, p2 for a, p1 again after the opaque item, which
+    # stays bound for the overlay
+    assert stats['program_changes'] == 3, stats
+    assert len(queue) == 0
+    print('render_queue_order_check passed')
+
+
+if __name__ == '__main__':
+    slot_hold_check()
+    capture_alignment_check()
+    async_drop_check()
+    render_graph_alias_check()
+    render_queue_order_check()
@@ -5,8 +5,12 @@ layout (location = 1) in vec2 texCoord;
 
 out vec2 TexCoord;
 
+uniform int flipVertical;
+
 void main()
 {
     gl_Position = position;
     TexCoord = texCoord;
+    if (flipVertical != 0)
+        TexCoord.y = 1.0 - texCoord.y;
 }
\ No newline at end of file
@@ -0,0 +1,17 @@
+#version 330 core
+
+layout (location = 0) in vec2 corner;
+layout (location = 1) in vec2 center;
+layout (location = 2) in vec3 color;
+out vec3 ourColor;
+
+// Centers are in image pixels, top-left origin
+uniform vec2 imageSize;
+uniform float pointSize;
+
+void main()
+{
+    vec2 pos = (center + corner * pointSize) / imageSize * 2.0 - 1.0;
+    gl_Position = vec4(pos.x, -pos.y, 0.0, 1.0);
+    ourColor = color;
+}
\ No newline at end of file
@@ -0,0 +1,16 @@
+#version 330 core
+
+in vec2 TexCoord;
+out vec4 color;
+
+uniform sampler2D labelTexture;
+uniform int useTexture;
+uniform vec4 overlayColor;
+
+void main()
+{
+    if (useTexture != 0)
+        color = texture(labelTexture, TexCoord) * overlayColor;
+    else
+        color = overlayColor;
+}
\ No newline at end of file
@@ -0,0 +1,14 @@
+#version 330 core
+
+layout (location = 0) in vec2 position;
+out vec2 TexCoord;
+
+// x, y, width, height in normalized device coordinates
+uniform vec4 rect;
+
+void main()
+{
+    gl_Position = vec4(rect.xy + position * rect.zw, 0.0, 1.0);
+    // Label images are top-down
+    TexCoord = vec2(position.x, 1.0 - position.y);
+}
\ No newline at end of file
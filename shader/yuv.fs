@@ -0,0 +1,29 @@
+#version 330 core
+
+in vec2 TexCoord;
+out vec4 color;
+
+uniform sampler2D yTexture;
+uniform sampler2D uTexture;
+uniform sampler2D vTexture;
+
+// 0: NV12, 1: I420, 2: YUYV
+uniform int yuvLayout;
+uniform mat3 yuvMatrix;
+uniform vec3 yuvOffset;
+
+void main()
+{
+    float y = texture(yTexture, TexCoord).r;
+    vec2 uv;
+    if (yuvLayout == 0)
+        uv = texture(uTexture, TexCoord).rg;
+    else if (yuvLayout == 1)
+        uv = vec2(texture(uTexture, TexCoord).r,
+                  texture(vTexture, TexCoord).r);
+    else
+        uv = texture(uTexture, TexCoord).ga;
+
+    vec3 rgb = yuvMatrix * (vec3(y, uv) - yuvOffset);
+    color = vec4(clamp(rgb, 0.0, 1.0), 1.0);
+}
\ No newline at end of file
@@ -0,0 +1,164 @@
+import json
+import numpy as np
+import os
+import threading
+import time
+
+
+# Spans are only recorded while enabled; disabled spans cost one check
+enabled = False
+
+
+class SpanBuffer:
+
+    # Preallocated ring of (start, duration, thread) in nanoseconds.
+    # Capture, worker and render threads record into the same buffers.
+    def __init__(self, name, capacity=4096):
+        self.name = name
+        self.capacity = capacity
+        self.count = 0
+        self._starts = np.zeros(capacity, dtype='int64')
+        self._durations = np.zeros(capacity, dtype='int64')
+        self._threads = np.zeros(capacity, dtype='int64')
+        self._lock = threading.Lock()
+
+    def record(self, start, duration, thread):
+        with self._lock:
+            i = self.count % self.capacity
+            self._starts[i] = start
+            self._durations[i] = duration
+            self._threads[i] = thread
+            self.count += 1
+
+    # Copies of the recorded spans, oldest first
+    def spans(self):
+        with self._lock:
+            n = min(self.count, self.capacity)
+            order = np.arange(self.count - n, self.count) % self.capacity
+            return (self._starts[order],
+                    self._durations[order],
+                    self._threads[order])
+
+    def reset(self):
+        with self._lock:
+            self.count = 0
+
+
+class Tracer:
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self._buffers = {}
+        self._lock = threading.Lock()
+
+    def buffer(self, name):
+        buffer = self._buffers.get(name)
+        if buffer is None:
+            with self._lock:
+                buffer = self._buffers.get(name)
+                if buffer is None:
+                    buffer = SpanBuffer(name, self.capacity)
+                    self._buffers[name] = buffer
+        return buffer
+
+    def span(self, name):
+        return _Span(self.buffer(name))
+
+    # Buffers may be added by other threads while we iterate
+    def _items(self):
+        with self._lock:
+            return sorted(self._buffers.items())
+
+    def reset(self):
+        for _, buffer in self._items():
+            buffer.reset()
+
+    # Milliseconds per span name
+    def stats(self):
+        stats = {}
+        for name, buffer in self._items():
+            _, durations, _ = buffer.spans()
+            if durations.size == 0:
+                continue
+            data = durations / 1e6
+            p50, p95, p99 = np.percentile(data, [50, 95, 99])
+            stats[name] = {
+                'count': buffer.count,
+                'mean': float(data.mean()),
+                'max': float(data.max()),
+                'p50': float(p50),
+                'p95': float(p95),
+                'p99': float(p99),
+            }
+        return stats
+
+    def to_json(self):
+        return json.dumps(self.stats(), indent=2)
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            f.write(self.to_json())
+
+    # Trace Event Format, loadable in chrome://tracing or Perfetto
+    def chrome_trace(self):
+        events = []
+        pid = os.getpid()
+        for name, buffer in self._items():
+            starts, durations, threads = buffer.spans()
+            for start, duration, thread in zip(starts, durations, threads):
+                events.append({
+                    'name': name,
+                    'ph': 'X',
+                    'ts': start / 1e3,
+                    'dur': duration / 1e3,
+                    'pid': pid,
+                    'tid': int(thread),
+                })
+        events.sort(key=lambda e: e['ts'])
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def dump_chrome_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+
+class _Span:
+
+    __slots__ = ('_buffer', '_start')
+
+    def __init__(self, buffer):
+        self._buffer = buffer
+
+    def __enter__(self):
+        self._start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        end = time.perf_counter_ns()
+        self._buffer.record(
+            self._start, end - self._start, threading.get_ident())
+
+
+class _NullSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+
+tracer = Tracer()
+_null_span = _NullSpan()
+
+
+def enable(value=True):
+    global enabled
+    enabled = value
+
+
+# with span('stage'): ...
+def span(name):
+    if not enabled:
+        return _null_span
+    return tracer.span(name)
@@ -4,11 +4,12 @@ import dlib
 import numpy as np
 import os
 import time
+import tracing
 
 from face_landmark import FaceDetector
 
 from cvutils import *
-from glview import GLView
+from glview import GLView, HeadlessGLView
 from renderer import *
 
 
@@ -17,17 +18,71 @@ HEIGHT = 720
 TITLE = 'Video capture'
 
 
-def test_vcgl_glview(frame_block=None):
-    with Webcam() as webcam:
+# source: any cvutils.VideoSource, the default camera if None
+def test_vcgl_glview(frame_block=None, record_path=None, trace_path=None,
+                     source=None, frame_hook=None):
+    tracing.enable(trace_path is not None)
+    if source is None:
+        source = Webcam()
+
+    with source:
+        glview = GLView(WIDTH, HEIGHT, TITLE)
+        video = VideoRenderer(
+            video_source=source,
+            frame_block=frame_block,
+            frame_hook=frame_hook
+        )
+        group = RendererGroup()
+        group.renderers = [video, FrameTimeRenderer(video.frame_timer)]
+        glview.renderer = group
+        # Redraw only when the source delivers a new frame
+        glview.on_demand = True
+
+        if record_path:
+            with VideoRecorder(record_path) as recorder:
+                glview.start_recording(recorder)
+                glview.run_loop()
+                glview.stop_recording()
+            print('recorder: {}'.format(recorder.stats))
+        else:
+            glview.run_loop()
+
+    print('frame times: {}'.format(video.frame_timer.stats()))
+    if trace_path:
+        print(tracing.tracer.to_json())
+        tracing.tracer.dump_chrome_trace(trace_path)
+
+
+# sources: several VideoSource objects shown side by side, e.g.
+#   [Webcam(0), Webcam(1)] or [FileSource(a), FileSource(b)]
+def test_vcgl_multi(sources, tolerance=1.0 / 60):
+    with CaptureManager(sources, tolerance=tolerance) as capture:
         glview = GLView(WIDTH, HEIGHT, TITLE)
-        glview.renderer = VideoRenderer(
+        group = TiledRendererGroup(capture=capture)
+        group.renderers = [
+            VideoRenderer(video_source=capture.channel(i))
+            for i in range(len(sources))
+        ]
+        glview.renderer = group
+        glview.on_demand = True
+        glview.run_loop()
+
+    for i, stats in enumerate(capture.stats):
+        print('camera {}: {}'.format(i, stats))
+
+
+def test_vcgl_yuv(fourcc='YUYV', matrix='bt601'):
+    with Webcam(convert_rgb=False, fourcc=fourcc) as webcam:
+        glview = GLView(WIDTH, HEIGHT, TITLE)
+        glview.renderer = YUVVideoRenderer(
             video_source=webcam,
-            frame_block=frame_block
+            matrix=matrix
         )
+        glview.on_demand = True
         glview.run_loop()
 
 
-def test_vcgl(frame_block=None):
+def test_vcgl(frame_block=None, source=None):
     # save current working directory
     cwd = os.getcwd()
 
@@ -56,21 +111,28 @@ def test_vcgl(frame_block=None):
 
     glClearColor(0.5, 0.5, 0.5, 1.0)
 
-    renderer = TextureRenderer()
+    renderer = TextureRenderer(channel_order='bgr', flip=True)
     renderer.prepare()
 
     fps_checker = FPSChecker()
 
-    webcam = Webcam()
-    with webcam:
+    if source is None:
+        source = Webcam()
+    with source:
+        sequence = -1
         while not glfw.WindowShouldClose(win):
-            frame = webcam.frame
+            latest = source.wait_for_frame(sequence, timeout=1.0)
+            if latest is None:
+                glfw.PollEvents()
+                continue
+            sequence = latest.seq
+
+            frame = latest.image
             if frame_block:
-                frame = frame_block(frame)
+                # The slot is shared with the capture thread
+                frame = frame_block(np.copy(frame))
             fps_checker.lab(frame)
 
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            frame = frame[::-1, ...]
             renderer.image = frame
 
             glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
@@ -117,8 +179,24 @@ def draw_shapes(image, shapes):
         draw_shape(image, shape)
 
 
-def test_vc_bb():
+# VideoRenderer frame_hook drawing the detections into the renderer's
+# copy of the frame. The grayscale detection input comes from the
+# source's DetectionGray step.
+def detection_hook(detector):
+    def _hook(frame, image):
+        rects, shapes = detector.detect_frame(frame)
+        if len(rects) > 0:
+            draw_bboxes(image, rects)
+            draw_shapes(image, shapes)
+        return image
+
+    return _hook
+
+
+def test_vc_bb(record_path=None, source=None):
     detector = FaceDetector()
+    if source is None:
+        source = Webcam(steps=[DetectionGray(detector.width)])
 
     def _block(frame):
         rects, shapes = detector.detect(frame)
@@ -129,20 +207,112 @@ def test_vc_bb():
 
     # test_vc(frame_block=_block)
     # test_vcgl(frame_block=_block)
-    test_vcgl_glview(frame_block=_block)
+    test_vcgl_glview(
+        frame_hook=detection_hook(detector),
+        record_path=record_path,
+        source=source
+    )
+
+
+# Detection on a worker thread: the display follows the camera and shows
+# the newest finished detection. With gl_landmarks the points are drawn
+# by a LandmarkRenderer instead of into the frame.
+def test_vc_bb_async(source=None, max_in_flight=2, gl_landmarks=False,
+                     tracking=True):
+    detector = FaceDetector(tracking=tracking)
+    if source is None:
+        source = Webcam(steps=[DetectionGray(detector.width)])
+
+    def _composite(image, result):
+        rects, shapes = result
+        if len(rects) > 0:
+            draw_bboxes(image, rects)
+            draw_shapes(image, shapes)
+        return image
+
+    # The worker only needs the small gray image, not the whole frame
+    processor = AsyncProcessor(
+        detector.detect_frame,
+        max_in_flight=max_in_flight,
+        variants=('gray', 'gray_scale'),
+        copy_image=False
+    )
+    with source, processor:
+        glview = GLView(WIDTH, HEIGHT, TITLE)
+        video = VideoRenderer(
+            video_source=source,
+            processor=processor,
+            composite=None if gl_landmarks else _composite
+        )
+        group = RendererGroup()
+        group.renderers = [video, FrameTimeRenderer(video.frame_timer)]
+
+        if gl_landmarks:
+            landmarks = LandmarkRenderer(
+                image_size=(int(source.width), int(source.height)))
+            landmarks.layer = 1
+            group.renderers.append(landmarks)
+
+            def _update_landmarks():
+                landmarks.landmarks = processor.result[1]
+            processor.result_listeners.append(_update_landmarks)
+
+        glview.renderer = group
+        glview.on_demand = True
+        glview.run_loop()
+
+    print('frame times: {}'.format(video.frame_timer.stats()))
+    print('processor: {}'.format(processor.stats()))
 
 
-def test_vc(frame_block=None):
+# Detect-and-render throughput without a camera or a window. The source
+# runs in lockstep so every run processes the same frames.
+# tracking: compare detect-every-frame with detect-then-track
+def benchmark_bb(source=None, frames=300, tracking=False):
+    detector = FaceDetector(tracking=tracking)
+    if source is None:
+        source = SyntheticSource(
+            WIDTH, HEIGHT,
+            realtime=False,
+            steps=[DetectionGray(detector.width)]
+        )
+
+    with source:
+        glview = HeadlessGLView(WIDTH, HEIGHT)
+        video = VideoRenderer(
+            video_source=source, frame_hook=detection_hook(detector))
+        glview.renderer = video
+        glview.on_demand = True
+
+        started = time.perf_counter()
+        glview.run_loop(max_frames=frames)
+        elapsed = time.perf_counter() - started
+
+    print('{} frames in {:.2f} s ({:.1f} fps)'.format(
+        frames, elapsed, frames / elapsed))
+    print('detections: {}, tracked: {}'.format(
+        detector.detections, detector.tracked))
+    print('frame times: {}'.format(video.frame_timer.stats()))
+
+
+def test_vc(frame_block=None, source=None):
     fps_checker = FPSChecker()
 
-    webcam = Webcam()
-    with webcam:
+    if source is None:
+        source = Webcam()
+    with source:
+        sequence = -1
         while True:
-            frame = webcam.frame
-            fps_checker.lab(frame)
+            latest = source.wait_for_frame(sequence, timeout=1.0)
+            if latest is None:
+                break
+            sequence = latest.seq
 
+            # Drawn into below; the slot is shared with the capture thread
+            frame = np.copy(latest.image)
             if frame_block:
                 frame = frame_block(frame)
+            fps_checker.lab(frame)
             cv2.imshow(TITLE, frame)
 
             if cv2.waitKey(1) & 0xFF == ord('q'):
@@ -156,4 +326,5 @@ if __name__ == '__main__':
     # test_vc()
     # test_vcgl()
     # test_vcgl_glview()
+    # test_vcgl_yuv()
     test_vc_bb()